@@ -1,41 +1,84 @@
+import time
+# 記錄模組開始匯入與匯入完成的時間，用於回報啟動耗時
+IMPORT_STARTED_AT = time.perf_counter()
+APP_READY_AT = None
+
 import os
 import json
-import pickle
 import numpy as np
-import requests
+import httpx
+import asyncio
+import functools
+import random
 import re
 import uuid
 import shutil
-import atexit
-import time
 import traceback
-import tempfile
-from typing import List, Dict, Tuple, Optional, Any
+import io
+import queue
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import importlib
+import contextlib
+import copy
+import mmap
+import sqlite3
+import threading
+from collections import OrderedDict, Counter
+from typing import List, Dict, Tuple, Optional, Any, Callable
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Depends, Cookie, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 from dotenv import load_dotenv
 import warnings
 import uvicorn
 
-# PDF 和 OCR 相關
-import PyPDF2
-from pdf2image import convert_from_bytes
-import pytesseract
-from PIL import Image
+# sentence_transformers（連帶 torch）以及 PDF、OCR 相關的套件匯入較慢，在第一次使用時才匯入
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只能以單一工作行程執行
+    fcntl = None
 
 warnings.filterwarnings('ignore')
 
 # 載入環境變數
 load_dotenv()
 
+# 近似最近鄰（ANN）檢索設定：ANN_BACKEND 為 "exact" 或 "ivf"，
+# 段落數少於 ANN_MIN_VECTORS 時仍使用精確檢索
+ANN_BACKEND = os.getenv('ANN_BACKEND', 'exact')
+ANN_MIN_VECTORS = int(os.getenv('ANN_MIN_VECTORS', '20000'))
+IVF_NLIST = int(os.getenv('IVF_NLIST', '0'))  # 0 表示依段落數自動決定
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', '16'))
+
+# 向量壓縮設定：VECTOR_QUANTIZATION 為 "none"、"float16" 或 "int8"，VECTOR_DIMS 大於 0 時壓縮向量只保留前幾維；
+# VECTOR_RESCORE_FACTOR 大於 0 時在壓縮向量上取 k 的倍數個候選，再以磁碟上的 float32 向量重新計分
+VECTOR_QUANTIZATION = os.getenv('VECTOR_QUANTIZATION', 'none')
+VECTOR_DIMS = int(os.getenv('VECTOR_DIMS', '0'))
+VECTOR_RESCORE_FACTOR = int(os.getenv('VECTOR_RESCORE_FACTOR', '4'))
+
+# 多課程設定：未指定 course_id 的請求使用預設課程，其他課程的索引存放在 COURSES_DIR 下
+DEFAULT_COURSE_ID = "default"
+COURSES_DIR = os.path.join("uploads", "courses")
+COURSE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def course_data_dir(course_id: str) -> str:
+    """課程資料的目錄：預設課程沿用原本的 uploads/index，其他課程存放在 uploads/courses/<course_id>/index"""
+    return "uploads" if course_id == DEFAULT_COURSE_ID else os.path.join(COURSES_DIR, course_id)
+
 class QueryRequest(BaseModel):
     question: str
     session_id: Optional[str] = None
+    course_id: str = DEFAULT_COURSE_ID
+
+class BatchQueryRequest(BaseModel):
+    questions: List[str]
+    course_id: str = DEFAULT_COURSE_ID
 
 class QuestionGenRequest(BaseModel):
     num_questions: int = 5
@@ -45,6 +88,11 @@ class ConversationResponse(BaseModel):
     sources: str
     history: List[Dict[str, str]]
     session_id: str
+    # 本次請求等待速率限制器的時間（毫秒）
+    limiter_wait_ms: float = 0.0
+
+class BatchQueryResponse(BaseModel):
+    results: List[ConversationResponse]
 
 # 用於存儲對話歷史的類
 class Conversation:
@@ -64,101 +112,2700 @@ class Conversation:
             "session_id": self.session_id,
             "history": self.history
         }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Conversation":
+        conversation = cls(data["session_id"])
+        conversation.history = data["history"]
+        return conversation
+
+class ConversationStore:
+    """有上限的對話存放區
+    
+    最近使用的對話保留在記憶體中；閒置超過 ttl_seconds 或常駐數量超過 max_resident 時，
+    將最久未使用的對話寫入 SQLite 並移出記憶體，之後以相同 session_id 存取時再從磁碟載回。
+    磁碟上超過 retention_seconds 未使用的對話會被刪除
+    """
+    def __init__(self, cache_dir: str, max_resident: int = 1000, ttl_seconds: float = 1800,
+                 retention_seconds: float = 30 * 86400):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'conversations.sqlite')
+        self.max_resident = max_resident
+        self.ttl_seconds = ttl_seconds
+        self.retention_seconds = retention_seconds
+        # session_id -> (對話, 最後使用時間)，依使用時間排序
+        self._resident = OrderedDict()
+        self.spills = 0
+        self.expirations = 0
+        self.reloads = 0
+        self.purged = 0
+        self._last_purge = 0.0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        # 移出發生在請求路徑上，使用 WAL 降低每次寫入的同步成本
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS conversations (session_id TEXT PRIMARY KEY, history TEXT NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS conversations_last_used ON conversations (last_used)")
+        self._db.commit()
+        with self._lock:
+            self._purge_expired(time.time())
+    
+    def get(self, session_id: str) -> Optional[Conversation]:
+        """取得對話，不在記憶體中時從磁碟載回；不存在時返回 None"""
+        with self._lock:
+            entry = self._resident.get(session_id)
+            if entry is not None:
+                conversation = entry[0]
+            else:
+                row = self._db.execute(
+                    "SELECT history FROM conversations WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                conversation = Conversation.from_dict({"session_id": session_id, "history": json.loads(row[0])})
+                # 載回記憶體後以記憶體中的版本為準，移出時再重新寫入
+                self._db.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+                self._db.commit()
+                self.reloads += 1
+            self._keep(conversation)
+            return conversation
+    
+    def add(self, conversation: Conversation):
+        with self._lock:
+            self._keep(conversation)
+    
+    def touch(self, conversation: Conversation):
+        """對話更新後呼叫；若回答期間對話已被移出記憶體，重新放回以免遺失新訊息"""
+        with self._lock:
+            entry = self._resident.get(conversation.session_id)
+            if entry is not None and entry[0] is not conversation:
+                return
+            if entry is None:
+                self._db.execute("DELETE FROM conversations WHERE session_id = ?", (conversation.session_id,))
+                self._db.commit()
+            self._keep(conversation)
+    
+    def _keep(self, conversation: Conversation):
+        now = time.time()
+        self._resident[conversation.session_id] = (conversation, now)
+        self._resident.move_to_end(conversation.session_id)
+        self._evict(now)
+    
+    def _evict(self, now: float):
+        """將閒置過久或超出常駐上限的對話寫入磁碟"""
+        spilled = []
+        while self._resident:
+            session_id, (conversation, last_used) = next(iter(self._resident.items()))
+            expired = now - last_used > self.ttl_seconds
+            if not expired and len(self._resident) <= self.max_resident:
+                break
+            del self._resident[session_id]
+            spilled.append((session_id, json.dumps(conversation.history, ensure_ascii=False), last_used))
+            if expired:
+                self.expirations += 1
+            else:
+                self.spills += 1
+        if spilled:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO conversations (session_id, history, last_used) VALUES (?, ?, ?)", spilled
+            )
+            self._db.commit()
+        # 每小時最多清理一次過期的磁碟對話
+        if now - self._last_purge > 3600:
+            self._purge_expired(now)
+    
+    def _purge_expired(self, now: float):
+        """刪除磁碟上超過保留期限的對話"""
+        self._last_purge = now
+        if self.retention_seconds <= 0:
+            return
+        cursor = self._db.execute("DELETE FROM conversations WHERE last_used < ?", (now - self.retention_seconds,))
+        self.purged += cursor.rowcount
+        self._db.commit()
+    
+    def flush(self):
+        """將記憶體中的所有對話寫入磁碟，用於關閉服務前"""
+        with self._lock:
+            rows = [(session_id, json.dumps(conversation.history, ensure_ascii=False), last_used)
+                    for session_id, (conversation, last_used) in self._resident.items()]
+            self._db.executemany(
+                "INSERT OR REPLACE INTO conversations (session_id, history, last_used) VALUES (?, ?, ?)", rows
+            )
+            self._db.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        """回傳常駐與已寫入磁碟的對話數量、估計記憶體用量與移出次數"""
+        with self._lock:
+            resident = len(self._resident)
+            messages = sum(len(conversation.history) for conversation, _ in self._resident.values())
+            text_bytes = sum(len(message["content"].encode('utf-8'))
+                             for conversation, _ in self._resident.values() for message in conversation.history)
+            spilled = self._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        return {
+            "resident": resident,
+            "max_resident": self.max_resident,
+            "resident_messages": messages,
+            "resident_text_bytes": text_bytes,
+            "spilled": spilled,
+            "file_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "ttl_seconds": self.ttl_seconds,
+            "expirations": self.expirations,
+            "spills": self.spills,
+            "reloads": self.reloads,
+            "purged": self.purged
+        }
+
+class FileLock:
+    """以 fcntl.flock 在多個 uvicorn 工作行程之間協調的鎖；沒有 fcntl 的平台上不做任何事
+    
+    同一行程內共用一個檔案描述元，呼叫端需另以 threading.Lock 序列化行程內的執行緒
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+    
+    @contextlib.contextmanager
+    def acquire(self, shared: bool = False):
+        if fcntl is None:
+            yield
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, 'a')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+class EmbeddingCache:
+    """以 (模型名稱, 段落雜湊) 為鍵的磁碟嵌入向量快取，跨工作階段與重啟共用
+    
+    向量存放在記憶體映射的 float32 檔案中，雜湊與槽位的對應存放在 SQLite，
+    超過 max_entries 時淘汰最久未使用的項目並重複使用其槽位。
+    多個工作行程共用同一個快取：寫入時持有檔案鎖並以 SQLite 的內容分配槽位，
+    淘汰項目時遞增 epoch，其他行程發現 epoch 改變後重新讀取對應表，避免讀到被重複使用的槽位。
+    命中時只在記憶體中記錄使用時間，每隔 touch_interval 秒或寫入新項目時才批次寫回 SQLite
+    """
+    def __init__(self, cache_dir: str, model_name: str, max_entries: int = 200000, touch_interval: float = 30.0):
+        self.cache_dir = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # 尚未寫回 SQLite 的使用時間：{鍵: 最後使用時間}
+        self._touched: Dict[str, float] = {}
+        self._touched_flushed_at = time.monotonic()
+        self._vectors_path = os.path.join(self.cache_dir, 'vectors.f32')
+        self._vectors = None
+        self._file_lock = FileLock(os.path.join(self.cache_dir, 'cache.lock'))
+        
+        self._db = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.commit()
+        
+        self._epoch = None
+        self._sync()
+    
+    def _read_meta(self, name: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+    
+    def _sync(self):
+        """其他行程淘汰過項目（epoch 改變）時重新讀取對應表，並重新映射被其他行程擴充的向量檔案"""
+        epoch = int(self._read_meta('epoch') or 0)
+        if epoch != self._epoch:
+            dim = self._read_meta('dim')
+            self.dim = int(dim) if dim else None
+            # 依最後使用時間排序，OrderedDict 的開頭即為最久未使用的項目
+            self._index = OrderedDict(self._db.execute("SELECT key, slot FROM entries ORDER BY last_used"))
+            self._next_slot = max(self._index.values(), default=-1) + 1
+            self._epoch = epoch
+            self._vectors = None
+        if self.dim is not None and os.path.exists(self._vectors_path):
+            rows = self._vectors.shape[0] if self._vectors is not None else 0
+            if os.path.getsize(self._vectors_path) // (self.dim * 4) > rows:
+                self._open_vectors()
+    
+    def _open_vectors(self):
+        rows = os.path.getsize(self._vectors_path) // (self.dim * 4)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(rows, self.dim)) if rows else None
+    
+    def _ensure_capacity(self, rows: int):
+        """確保向量檔案至少有 rows 列，不足時以倍數擴充"""
+        current = self._vectors.shape[0] if self._vectors is not None else 0
+        if rows <= current:
+            return
+        # 其他行程可能已擴充檔案，不可截短
+        current = max(current, os.path.getsize(self._vectors_path) // (self.dim * 4) if os.path.exists(self._vectors_path) else 0)
+        new_rows = min(max(rows, current * 2, 1024), max(self.max_entries, rows))
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self._vectors_path, 'ab') as f:
+            f.truncate(new_rows * self.dim * 4)
+        self._open_vectors()
+    
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    
+    def _allocate_slot(self, count: int) -> Tuple[int, bool]:
+        """分配槽位，返回 (槽位, 是否淘汰了舊項目)；count 為目前的項目數（含本批已寫入的項目），需持有檔案鎖"""
+        if count < self.max_entries:
+            slot = self._next_slot
+            self._next_slot = slot + 1
+            return slot, False
+        # 以 SQLite 中的最後使用時間選擇淘汰對象，其他行程的存取也會反映在其中
+        old_key, slot = self._db.execute("SELECT key, slot FROM entries ORDER BY last_used LIMIT 1").fetchone()
+        self._db.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+        self._index.pop(old_key, None)
+        self.evictions += 1
+        return slot, True
+    
+    def encode(self, texts: List[str], encode_fn) -> np.ndarray:
+        """取得 texts 的嵌入向量，只對快取中不存在的段落呼叫 encode_fn；max_entries 為 0 時不使用快取"""
+        result, missing = self.lookup(texts)
+        if missing:
+            miss_texts = [texts[idx[0]] for idx in missing.values()]
+            self.store(missing, encode_fn(miss_texts), result)
+        return self.stack(result)
+    
+    def lookup(self, texts: List[str]) -> Tuple[List[Optional[np.ndarray]], "OrderedDict[str, List[int]]"]:
+        """查詢快取，返回 (各段落的向量，未命中為 None, {未命中的鍵: 段落位置})"""
+        keys = [self._key(text) for text in texts]
+        result = [None] * len(texts)
+        missing = OrderedDict()
+        if self.max_entries <= 0:
+            for i, key in enumerate(keys):
+                missing.setdefault(key, []).append(i)
+            self.misses += len(texts)
+            return result, missing
+        now = time.time()
+        
+        with self._lock, self._file_lock.acquire(shared=True):
+            self._sync()
+            for i, key in enumerate(keys):
+                slot = self._index.get(key)
+                if slot is not None and self._vectors is not None:
+                    self._index.move_to_end(key)
+                    result[i] = np.array(self._vectors[slot])
+                    self._touched[key] = now
+                else:
+                    missing.setdefault(key, []).append(i)
+            self.hits += len(texts) - sum(len(idx) for idx in missing.values())
+            self.misses += sum(len(idx) for idx in missing.values())
+            if self._touched and time.monotonic() - self._touched_flushed_at >= self.touch_interval:
+                self._write_touched()
+                self._db.commit()
+        return result, missing
+    
+    def _write_touched(self):
+        """將累積的使用時間寫入 SQLite（不提交），呼叫端需持有 self._lock"""
+        if self._touched:
+            self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                 [(last_used, key) for key, last_used in self._touched.items()])
+            self._touched.clear()
+        self._touched_flushed_at = time.monotonic()
+    
+    def flush(self):
+        """立即寫回累積的使用時間"""
+        if self.max_entries <= 0:
+            return
+        with self._lock, self._file_lock.acquire(shared=True):
+            if self._touched:
+                self._write_touched()
+                self._db.commit()
+    
+    def store(self, missing: "OrderedDict[str, List[int]]", new_vectors, result: List[Optional[np.ndarray]]):
+        """將 lookup 未命中的段落的向量填入 result 並寫入快取"""
+        new_vectors = np.asarray(new_vectors, dtype=np.float32)
+        if self.max_entries <= 0:
+            for indices, vector in zip(missing.values(), new_vectors):
+                for i in indices:
+                    result[i] = vector
+            return
+        now = time.time()
+        
+        with self._lock, self._file_lock.acquire():
+            self._sync()
+            # 淘汰依 SQLite 的 last_used 選擇，先寫回本行程累積的使用時間
+            self._write_touched()
+            if self.dim is None:
+                self.dim = int(new_vectors.shape[1])
+                self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (str(self.dim),))
+            # 其他行程可能已寫入相同的段落
+            missing_keys = list(missing)
+            for start in range(0, len(missing_keys), 500):
+                batch = missing_keys[start:start + 500]
+                self._index.update(self._db.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch
+                ))
+            count, next_slot = self._db.execute("SELECT COUNT(*), COALESCE(MAX(slot), -1) + 1 FROM entries").fetchone()
+            self._next_slot = max(self._next_slot, next_slot)
+            evicted = False
+            for (key, indices), vector in zip(missing.items(), new_vectors):
+                for i in indices:
+                    result[i] = vector
+                if key in self._index:
+                    continue
+                slot, reused = self._allocate_slot(count)
+                evicted = evicted or reused
+                if not reused:
+                    count += 1
+                self._ensure_capacity(slot + 1)
+                self._vectors[slot] = vector
+                self._index[key] = slot
+                # 立即寫入，一批超過 max_entries 時也能淘汰本批較早寫入的項目
+                self._db.execute("INSERT OR REPLACE INTO entries (key, slot, last_used) VALUES (?, ?, ?)", (key, slot, now))
+            if evicted:
+                self._epoch = (self._epoch or 0) + 1
+                self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('epoch', ?)", (str(self._epoch),))
+            self._db.commit()
+            if self._vectors is not None:
+                self._vectors.flush()
+    
+    def stack(self, result: List[np.ndarray]) -> np.ndarray:
+        if not result:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.stack(result).astype(np.float32, copy=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        """回傳快取的命中統計與大小"""
+        total = self.hits + self.misses
+        return {
+            "model_name": self.model_name,
+            "entries": len(self._index),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "evictions": self.evictions
+        }
+
+class OCRCache:
+    """以 (頁面內容雜湊, OCR 語言, dpi) 為鍵的磁碟 OCR 結果快取，重複上傳相同的掃描頁面時跳過渲染與 OCR
+    
+    結果存放在 SQLite，超過 max_entries 時淘汰最久未使用的項目
+    """
+    def __init__(self, cache_dir: str, max_entries: int = 100000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'ocr.sqlite')
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 命中時省下的 OCR 時間（以寫入快取時記錄的耗時估算）
+        self.seconds_saved = 0.0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, text TEXT NOT NULL, seconds REAL NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self._db.commit()
+    
+    @staticmethod
+    def make_key(page_hash: str, lang: str, dpi: int) -> str:
+        return f"{page_hash}:{lang}:{dpi}"
+    
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """取得快取中存在的 OCR 結果，返回 {鍵: 文字}"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for key, text, seconds in self._db.execute(
+                    f"SELECT key, text, seconds FROM pages WHERE key IN ({placeholders})", batch
+                ):
+                    found[key] = text
+                    self.seconds_saved += seconds
+            if found:
+                now = time.time()
+                self._db.executemany("UPDATE pages SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._db.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+    
+    def put(self, key: str, text: str, seconds: float):
+        """寫入單頁的 OCR 結果與耗時"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages (key, text, seconds, last_used) VALUES (?, ?, ?, ?)",
+                (key, text, seconds, time.time())
+            )
+            count = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            if count > self.max_entries:
+                excess = count - self.max_entries
+                self._db.execute(
+                    "DELETE FROM pages WHERE key IN (SELECT key FROM pages ORDER BY last_used LIMIT ?)", (excess,)
+                )
+                self.evictions += excess
+            self._db.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        """回傳快取的命中統計、大小與省下的 OCR 時間"""
+        with self._lock:
+            entries, text_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM pages").fetchone()
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "text_bytes": text_bytes,
+            "file_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "seconds_saved": round(self.seconds_saved, 3)
+        }
+
+# 磁碟索引格式版本，格式不相容時遞增
+INDEX_FORMAT_VERSION = 1
+
+class ChunkTextStore:
+    """唯讀的段落序列，文字存放在單一 UTF-8 區塊中，以偏移量陣列按需解碼"""
+    def __init__(self, blob, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+    
+    def __len__(self):
+        return max(len(self._offsets) - 1, 0)
+    
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("段落索引超出範圍")
+        return self._blob[int(self._offsets[idx]):int(self._offsets[idx + 1])].decode('utf-8')
+    
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+def write_index(index_dir: str, chunks, vector_index: "VectorIndex", file_info: List[Dict], model_name: str,
+                lexical_index: Optional["LexicalIndex"] = None) -> str:
+    """將段落與嵌入向量寫成新的索引世代，並以原子方式切換 CURRENT 指標
+    
+    每個世代包含 vectors.npy（float32 向量矩陣）、texts.bin（UTF-8 文字區塊）、
+    offsets.npy（每個段落在文字區塊中的起訖位置）與 manifest.json，
+    啟用 IVF 時另外保存 ivf_centroids.npy 與 ivf_assignments.npy，
+    啟用向量壓縮時另外保存 vectors.<類型>.npy（int8 另有 quant_scale.npy 與 quant_offset.npy），
+    有詞彙索引時另外保存 lexical.bin、lexical.json 與詞項字典的陣列檔案（見 LexicalIndex.save）。
+    多個工作行程時呼叫端需持有索引的 FileLock，避免同時寫入相同的世代編號
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    current = read_current_generation(index_dir)
+    generation = (current or 0) + 1
+    generation_name = f"gen-{generation:06d}"
+    tmp_path = os.path.join(index_dir, f".tmp-{uuid.uuid4().hex}")
+    os.makedirs(tmp_path)
+    
+    vectors = np.asarray(vector_index.vectors, dtype=np.float32)
+    if vectors.ndim != 2:
+        vectors = vectors.reshape(len(chunks), -1) if len(chunks) else np.zeros((0, 0), dtype=np.float32)
+    np.save(os.path.join(tmp_path, 'vectors.npy'), vectors)
+    
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    with open(os.path.join(tmp_path, 'texts.bin'), 'wb') as f:
+        for i, chunk in enumerate(chunks):
+            data = chunk.encode('utf-8')
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    
+    ann = None
+    if vector_index.ivf is not None:
+        np.save(os.path.join(tmp_path, 'ivf_centroids.npy'), vector_index.ivf.centroids)
+        np.save(os.path.join(tmp_path, 'ivf_assignments.npy'), vector_index.ivf.assignments)
+        ann = {"backend": "ivf", "nlist": len(vector_index.ivf.centroids), "trained_size": vector_index.ivf.trained_size}
+    
+    quantization = None
+    quantized = vector_index.quantized_vectors() if len(chunks) else None
+    if quantized is not None:
+        quantized.save(tmp_path)
+        quantized.recall = quantized.estimate_recall(vectors)
+        quantization = {"type": quantized.kind, "dims": quantized.dims, "recall": quantized.recall}
+    
+    if lexical_index is not None:
+        lexical_index.save(tmp_path)
+    
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            "format_version": INDEX_FORMAT_VERSION,
+            "generation": generation,
+            "model_name": model_name,
+            "count": len(chunks),
+            "dim": int(vectors.shape[1]),
+            "created_at": time.time(),
+            "normalized": True,
+            "ann": ann,
+            "quantization": quantization,
+            "lexical": lexical_index is not None,
+            "file_info": file_info
+        }, f, ensure_ascii=False)
+    
+    generation_path = os.path.join(index_dir, generation_name)
+    os.rename(tmp_path, generation_path)
+    current_tmp = os.path.join(index_dir, f".CURRENT-{uuid.uuid4().hex}")
+    with open(current_tmp, 'w') as f:
+        f.write(generation_name)
+    os.replace(current_tmp, os.path.join(index_dir, 'CURRENT'))
+    
+    # 保留前一個世代，讓仍在讀取的請求可以完成
+    for name in os.listdir(index_dir):
+        if name.startswith("gen-") and int(name[4:]) < generation - 1:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+    return generation_path
+
+def read_current_generation(index_dir: str) -> Optional[int]:
+    """讀取 CURRENT 指標所指向的世代編號，不存在時返回 None"""
+    try:
+        with open(os.path.join(index_dir, 'CURRENT')) as f:
+            return int(f.read().strip()[4:])
+    except (OSError, ValueError):
+        return None
+
+def load_index(index_dir: str, model_name: str) -> Optional[Dict[str, Any]]:
+    """以記憶體映射方式開啟目前的索引世代，不複製向量與文字內容
+    
+    同一個世代的檔案由所有工作行程共同映射，作業系統只在記憶體中保留一份
+    """
+    while True:
+        generation = read_current_generation(index_dir)
+        if generation is None:
+            return None
+        try:
+            return _load_generation(index_dir, generation, model_name)
+        except FileNotFoundError:
+            # 讀取期間其他工作行程發布了更新的世代並刪除了這個世代，改為載入最新的世代
+            if read_current_generation(index_dir) == generation:
+                raise
+
+def _load_generation(index_dir: str, generation: int, model_name: str) -> Optional[Dict[str, Any]]:
+    generation_path = os.path.join(index_dir, f"gen-{generation:06d}")
+    with open(os.path.join(generation_path, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != INDEX_FORMAT_VERSION:
+        print(f"索引格式版本 {manifest.get('format_version')} 不相容，略過載入")
+        return None
+    if manifest.get("model_name") != model_name:
+        print(f"索引使用的模型 {manifest.get('model_name')} 與目前模型不同，略過載入")
+        return None
+    
+    vectors = np.load(os.path.join(generation_path, 'vectors.npy'), mmap_mode='r')
+    if not manifest.get("normalized"):
+        vectors = VectorIndex.normalize(vectors)
+    offsets = np.load(os.path.join(generation_path, 'offsets.npy'), mmap_mode='r')
+    texts_path = os.path.join(generation_path, 'texts.bin')
+    if os.path.getsize(texts_path):
+        with open(texts_path, 'rb') as f:
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        blob = b""
+    
+    ivf = None
+    if manifest.get("ann") and manifest["ann"].get("backend") == "ivf":
+        ivf = IVFIndex(
+            np.load(os.path.join(generation_path, 'ivf_centroids.npy')),
+            np.load(os.path.join(generation_path, 'ivf_assignments.npy'), mmap_mode='r'),
+            trained_size=manifest["ann"]["trained_size"]
+        )
+    
+    # 壓縮向量的設定與目前設定不同時不載入，由 VectorIndex 依目前設定重新建立
+    quantized = None
+    quantization = manifest.get("quantization")
+    if (quantization and quantization["type"] == VECTOR_QUANTIZATION
+            and quantization["dims"] == QuantizedVectors.target_dims(manifest["dim"])):
+        quantized = QuantizedVectors.load(generation_path, quantization["type"])
+        quantized.recall = quantization.get("recall")
+    
+    for info in manifest["file_info"]:
+        info["chunk_range"] = tuple(info["chunk_range"])
+    return {
+        "path": generation_path,
+        "manifest": manifest,
+        "course_data": ChunkTextStore(blob, offsets),
+        "embeddings": vectors,
+        "ivf": ivf,
+        "quantized": quantized,
+        "lexical": LexicalIndex.load(generation_path) if manifest.get("lexical") else None,
+        "file_info": manifest["file_info"]
+    }
+
+class IVFIndex:
+    """倒排檔（IVF）近似最近鄰索引：以球面 k-means 將向量分群，查詢時只掃描最接近的 nprobe 個群"""
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_size: int):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.trained_size = trained_size
+        self._lists = None
+    
+    @classmethod
+    def train(cls, vectors: np.ndarray, nlist: int = 0, iterations: int = 10, seed: int = 0) -> "IVFIndex":
+        """以抽樣的向量訓練群中心，再將所有向量分配到最近的群"""
+        n = len(vectors)
+        nlist = min(nlist or max(1, int(np.sqrt(n))), n)
+        rng = np.random.default_rng(seed)
+        sample_idx = np.sort(rng.choice(n, size=min(n, nlist * 40), replace=False))
+        sample = np.asarray(vectors[sample_idx], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind='stable')
+            present, starts = np.unique(labels[order], return_index=True)
+            sums = np.zeros_like(centroids)
+            sums[present] = np.add.reduceat(sample[order], starts, axis=0)
+            # 空的群以隨機樣本重新初始化
+            empty = np.setdiff1d(np.arange(nlist), present)
+            if len(empty):
+                sums[empty] = sample[rng.choice(len(sample), size=len(empty))]
+            centroids = VectorIndex.normalize(sums)
+        
+        ivf = cls(centroids, np.zeros(0, dtype=np.int32), trained_size=n)
+        ivf.assignments = ivf.assign(vectors)
+        return ivf
+    
+    def assign(self, vectors, block_size: int = 65536) -> np.ndarray:
+        """將向量分配到最接近的群中心，分塊計算以限制記憶體用量"""
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), block_size):
+            block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+            labels[start:start + block_size] = np.argmax(block @ self.centroids.T, axis=1)
+        return labels
+    
+    def splice(self, start: int, end: int, new_vectors: np.ndarray):
+        """與向量矩陣同步，以新向量的分群結果取代 [start, end) 的列"""
+        new_labels = self.assign(new_vectors) if len(new_vectors) else np.zeros(0, dtype=np.int32)
+        self.assignments = np.concatenate([self.assignments[:start], new_labels, self.assignments[end:]])
+        self._lists = None
+    
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind='stable')
+            bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, bounds)
+        return self._lists
+    
+    def search(self, score_rows: Callable[[np.ndarray, np.ndarray], np.ndarray], query: np.ndarray, k: int,
+               threshold: Optional[float], nprobe: int = IVF_NPROBE) -> Tuple[np.ndarray, np.ndarray]:
+        """只在最接近查詢的 nprobe 個群中計算相似度，score_rows(列索引, 查詢) 返回這些列的分數"""
+        order, bounds = self._inverted_lists()
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        candidates = np.concatenate([order[bounds[c]:bounds[c + 1]] for c in probes])
+        candidates.sort()
+        positions, scores = VectorIndex._top_k(score_rows(candidates, query), k, threshold)
+        return candidates[positions], scores
+
+class QuantizedVectors:
+    """壓縮儲存的正規化向量，用於第一階段計分
+    
+    kind 為 "float16" 時轉為半精度；為 "int8" 時每個維度依其最小值與最大值線性量化為 256 級（以 uint8 儲存）。
+    只保留前 dims 維時會重新正規化。numpy 沒有半精度與 8 位元整數的 BLAS，
+    計分時分塊轉回 float32 再做矩陣乘法；區塊小到可以留在 CPU 快取中，暫存的 float32 只有一個區塊
+    """
+    BLOCK_ROWS = 256
+    
+    def __init__(self, kind: str, codes: np.ndarray, scale: Optional[np.ndarray] = None,
+                 offset: Optional[np.ndarray] = None):
+        self.kind = kind
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+        # 寫入索引時估計的召回率
+        self.recall = None
+    
+    @property
+    def dims(self) -> int:
+        return int(self.codes.shape[1])
+    
+    @staticmethod
+    def target_dims(dim: int) -> int:
+        return min(VECTOR_DIMS, dim) if VECTOR_DIMS > 0 else dim
+    
+    @staticmethod
+    def _truncate(vectors, dims: int) -> np.ndarray:
+        block = np.asarray(vectors, dtype=np.float32)
+        if dims < block.shape[1]:
+            block = VectorIndex.normalize(block[:, :dims])
+        return block
+    
+    @classmethod
+    def build(cls, vectors, kind: str, dims: int, block_rows: int = 65536) -> "QuantizedVectors":
+        """以分塊方式壓縮 float32 向量"""
+        if kind not in ("float16", "int8"):
+            raise ValueError(f"不支援的向量壓縮類型: {kind}")
+        n = len(vectors)
+        if kind == "float16":
+            codes = np.empty((n, dims), dtype=np.float16)
+            for start in range(0, n, block_rows):
+                codes[start:start + block_rows] = cls._truncate(vectors[start:start + block_rows], dims)
+            return cls(kind, codes)
+        
+        low = np.full(dims, np.inf, dtype=np.float32)
+        high = np.full(dims, -np.inf, dtype=np.float32)
+        for start in range(0, n, block_rows):
+            block = cls._truncate(vectors[start:start + block_rows], dims)
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = (high - low) / 255
+        scale[scale == 0] = 1.0
+        codes = np.empty((n, dims), dtype=np.uint8)
+        for start in range(0, n, block_rows):
+            block = cls._truncate(vectors[start:start + block_rows], dims)
+            codes[start:start + block_rows] = np.clip(np.rint((block - low) / scale), 0, 255)
+        return cls(kind, codes, scale.astype(np.float32), low)
+    
+    def _weights(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """將查詢轉為對壓縮值計分的權重與常數項：q·x ≈ q·offset + (q*scale)·code"""
+        queries = self._truncate(np.atleast_2d(queries), self.dims)
+        if self.kind == "int8":
+            return np.ascontiguousarray((queries * self.scale).T), queries @ self.offset
+        return np.ascontiguousarray(queries.T), np.zeros(len(queries), dtype=np.float32)
+    
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """所有向量對每個查詢的近似相似度，形狀為 (查詢數, 向量數)"""
+        weights, bias = self._weights(queries)
+        out = np.empty((len(self.codes), weights.shape[1]), dtype=np.float32)
+        buffer = np.empty((self.BLOCK_ROWS, self.dims), dtype=np.float32)
+        for start in range(0, len(self.codes), self.BLOCK_ROWS):
+            block = self.codes[start:start + self.BLOCK_ROWS]
+            converted = buffer[:len(block)]
+            np.copyto(converted, block, casting='unsafe')
+            np.matmul(converted, weights, out=out[start:start + len(block)])
+        out += bias
+        return out.T
+    
+    def score_rows(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """指定列對單一查詢的近似相似度"""
+        weights, bias = self._weights(query)
+        return (np.asarray(self.codes[rows], dtype=np.float32) @ weights)[:, 0] + bias[0]
+    
+    def nbytes(self) -> int:
+        extra = self.scale.nbytes + self.offset.nbytes if self.scale is not None else 0
+        return int(self.codes.size * self.codes.itemsize + extra)
+    
+    def estimate_recall(self, vectors: np.ndarray, k: int = 10, sample: int = 32, seed: int = 0) -> Dict[str, float]:
+        """以抽樣的段落向量為查詢，估計壓縮計分與重新計分後的前 k 名與 float32 精確結果的重疊比例"""
+        n = len(vectors)
+        k = min(k, n)
+        queries = vectors[np.random.default_rng(seed).choice(n, size=min(sample, n), replace=False)]
+        exact = np.asarray(queries @ vectors.T)
+        approx = self.scores(queries)
+        fetch = min(k * max(VECTOR_RESCORE_FACTOR, 1), n)
+        plain, rescored = [], []
+        for exact_row, approx_row in zip(exact, approx):
+            truth = set(np.argpartition(-exact_row, k - 1)[:k].tolist())
+            candidates = np.argpartition(-approx_row, fetch - 1)[:fetch]
+            plain.append(len(truth & set(candidates[np.argsort(-approx_row[candidates])][:k].tolist())) / k)
+            rescored.append(len(truth & set(candidates[np.argsort(-exact_row[candidates])][:k].tolist())) / k)
+        return {
+            f"recall_at_{k}": round(float(np.mean(plain)), 4),
+            f"recall_at_{k}_rescored": round(float(np.mean(rescored)), 4)
+        }
+    
+    def save(self, path: str):
+        np.save(os.path.join(path, f'vectors.{self.kind}.npy'), self.codes)
+        if self.kind == "int8":
+            np.save(os.path.join(path, 'quant_scale.npy'), self.scale)
+            np.save(os.path.join(path, 'quant_offset.npy'), self.offset)
+    
+    @classmethod
+    def load(cls, path: str, kind: str) -> "QuantizedVectors":
+        """以記憶體映射方式開啟壓縮向量"""
+        codes = np.load(os.path.join(path, f'vectors.{kind}.npy'), mmap_mode='r')
+        if kind == "int8":
+            return cls(kind, codes, np.load(os.path.join(path, 'quant_scale.npy')),
+                       np.load(os.path.join(path, 'quant_offset.npy')))
+        return cls(kind, codes)
+
+class VectorIndex:
+    """向量檢索元件：向量在寫入時正規化一次，查詢時以單次矩陣乘法計分並用 argpartition 取前 k 名
+    
+    ANN_BACKEND 設為 "ivf" 且段落數足夠時，改用 IVFIndex 做近似檢索；
+    設定 VECTOR_QUANTIZATION 時先在 QuantizedVectors 上計分，float32 向量只用於重新計分少數候選
+    """
+    def __init__(self, vectors=None, ivf: Optional[IVFIndex] = None, quantized: Optional[QuantizedVectors] = None):
+        # vectors 必須已經過 normalize() 處理
+        if vectors is None or not len(vectors):
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        self.vectors = vectors
+        self.ivf = ivf
+        self.quantized = quantized
+        self._maybe_build_ann()
+    
+    def _maybe_build_ann(self):
+        """依設定建立或重新訓練 IVF 索引；段落數成長為訓練時的四倍以上時重新訓練"""
+        if ANN_BACKEND != 'ivf' or len(self.vectors) < ANN_MIN_VECTORS:
+            self.ivf = None
+            return
+        if self.ivf is None or len(self.vectors) > 4 * self.ivf.trained_size:
+            start_time = time.time()
+            self.ivf = IVFIndex.train(self.vectors, nlist=IVF_NLIST)
+            print(f"已建立 IVF 索引: {len(self.ivf.centroids)} 個群，耗時 {time.time() - start_time:.1f} 秒")
+    
+    def splice(self, start: int, end: int, new_vectors):
+        """以正規化後的 new_vectors 取代 [start, end) 的列，並同步更新 IVF 分群"""
+        new_vectors = self.normalize(new_vectors) if len(new_vectors) else None
+        parts = [np.asarray(self.vectors[:start]) if start else None,
+                 new_vectors,
+                 np.asarray(self.vectors[end:]) if end < len(self.vectors) else None]
+        parts = [part for part in parts if part is not None and len(part)]
+        self.vectors = np.concatenate(parts, axis=0) if parts else np.zeros((0, 0), dtype=np.float32)
+        if self.ivf is not None:
+            self.ivf.splice(start, end, new_vectors if new_vectors is not None else [])
+        # 壓縮向量在下次需要時重新建立，量化範圍隨之更新
+        self.quantized = None
+        self._maybe_build_ann()
+    
+    def __len__(self):
+        return len(self.vectors)
+    
+    def copy(self) -> "VectorIndex":
+        """複製索引供寫入端修改；splice 會整個替換向量與分群陣列，因此陣列本身可以共用"""
+        ivf = IVFIndex(self.ivf.centroids, self.ivf.assignments, self.ivf.trained_size) if self.ivf is not None else None
+        return VectorIndex(self.vectors if len(self.vectors) else None, ivf=ivf, quantized=self.quantized)
+    
+    def quantized_vectors(self) -> Optional[QuantizedVectors]:
+        """依 VECTOR_QUANTIZATION 取得壓縮向量，尚未建立或設定不同時從 float32 向量建立"""
+        if VECTOR_QUANTIZATION == 'none' or not len(self.vectors):
+            return None
+        dims = QuantizedVectors.target_dims(self.vectors.shape[1])
+        if self.quantized is None or self.quantized.kind != VECTOR_QUANTIZATION or self.quantized.dims != dims:
+            self.quantized = QuantizedVectors.build(self.vectors, VECTOR_QUANTIZATION, dims)
+        return self.quantized
+    
+    def _score_rows(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return np.asarray(self.vectors[rows]) @ query
+    
+    def _read_rows(self, rows: np.ndarray) -> np.ndarray:
+        """讀取指定列的 float32 向量
+        
+        記憶體映射的向量逐列以 pread 讀取：對映射區域做隨機存取時，核心會以大頁面映射並預讀，
+        少數幾列就會讓整個向量檔案進入行程的常駐記憶體
+        """
+        vectors = self.vectors
+        if not isinstance(vectors, np.memmap) or not hasattr(os, 'pread'):
+            return np.asarray(vectors[rows])
+        row_bytes = vectors.shape[1] * vectors.itemsize
+        out = np.empty((len(rows), vectors.shape[1]), dtype=np.float32)
+        try:
+            f = open(vectors.filename, 'rb')
+        except OSError:
+            # 索引世代已被清除時，已建立的映射仍然有效
+            return np.asarray(vectors[rows])
+        with f:
+            for i, row in enumerate(rows):
+                out[i] = np.frombuffer(os.pread(f.fileno(), row_bytes, vectors.offset + int(row) * row_bytes), dtype=np.float32)
+        return out
+    
+    def stats(self) -> Dict[str, Any]:
+        """回傳向量數量、float32 與壓縮向量的大小，以及寫入索引時估計的召回率"""
+        dim = int(self.vectors.shape[1]) if len(self.vectors) else 0
+        quantized = self.quantized
+        return {
+            "count": len(self.vectors),
+            "dim": dim,
+            "ann": "ivf" if self.ivf is not None else "exact",
+            "float32_bytes": len(self.vectors) * dim * 4,
+            "quantization": quantized.kind if quantized is not None else "none",
+            "quantized_dims": quantized.dims if quantized is not None else None,
+            "quantized_bytes": quantized.nbytes() if quantized is not None else 0,
+            "rescore_factor": VECTOR_RESCORE_FACTOR if quantized is not None else None,
+            "recall": quantized.recall if quantized is not None else None
+        }
+    
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        """將向量轉為 float32 並做 L2 正規化"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+    
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int, threshold: Optional[float]) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        if threshold is not None:
+            candidates = candidates[scores[candidates] > threshold]
+        return candidates, scores[candidates]
+    
+    def search(self, query, k: int = 3, threshold: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """回傳與查詢向量最相似的 k 個段落索引與餘弦相似度，依分數由高到低排序"""
+        if not len(self.vectors):
+            return self._top_k(np.zeros(0, dtype=np.float32), k, threshold)
+        return self.search_batch(np.asarray(query).reshape(1, -1), k, threshold)[0]
+    
+    def search_batch(self, queries, k: int = 3, threshold: Optional[float] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """以一次矩陣乘法為多個查詢計分"""
+        queries = self.normalize(queries)
+        if not len(self.vectors):
+            return [self._top_k(np.zeros(0, dtype=np.float32), k, threshold) for _ in range(len(queries))]
+        quantized = self.quantized_vectors()
+        if quantized is None:
+            if self.ivf is not None:
+                return [self.ivf.search(self._score_rows, query, k, threshold) for query in queries]
+            scores = queries @ self.vectors.T
+            return [self._top_k(row, k, threshold) for row in scores]
+        
+        # 第一階段在壓縮向量上取候選；不重新計分時直接返回近似分數
+        if VECTOR_RESCORE_FACTOR <= 0:
+            if self.ivf is not None:
+                return [self.ivf.search(quantized.score_rows, query, k, threshold) for query in queries]
+            return [self._top_k(row, k, threshold) for row in quantized.scores(queries)]
+        fetch = k * VECTOR_RESCORE_FACTOR
+        if self.ivf is not None:
+            coarse = [self.ivf.search(quantized.score_rows, query, fetch, None)[0] for query in queries]
+        else:
+            coarse = [self._top_k(row, fetch, None)[0] for row in quantized.scores(queries)]
+        results = []
+        for query, candidates in zip(queries, coarse):
+            candidates = np.sort(candidates)
+            positions, scores = self._top_k(self._read_rows(candidates) @ query, k, threshold)
+            results.append((candidates[positions], scores))
+        return results
+
+# 詞彙索引的詞項：中日韓文字取連續的字元二元組，英文與數字取整個單字（可含 . _ - 連接，如課號與公式名稱）
+LEXICAL_TOKEN = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]+|[a-z0-9]+(?:[._\-][a-z0-9]+)*')
+
+def lexical_tokens(text: str) -> List[str]:
+    """將文字切成詞彙索引使用的詞項"""
+    tokens = []
+    for match in LEXICAL_TOKEN.finditer(text.lower()):
+        run = match.group()
+        if CJK_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+def encode_varints(values) -> bytes:
+    """以 LEB128 varint 編碼非負整數序列"""
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+def decode_varints(data) -> np.ndarray:
+    """以向量化方式解碼 LEB128 varint 序列"""
+    arr = np.frombuffer(data, dtype=np.uint8)
+    if not len(arr):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(arr < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = 7 * (np.arange(len(arr)) - starts[group])
+    return np.add.reduceat((arr & 0x7f).astype(np.int64) << shifts, starts)
+
+@functools.lru_cache(maxsize=4096)
+def lexical_term_hash(term: str) -> np.uint64:
+    """詞項的 64 位元雜湊，跨行程穩定，用於排序與查詢 LexicalTermTable"""
+    return np.uint64(int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little'))
+
+class LexicalTermTable:
+    """以陣列存放的詞項字典，可直接記憶體映射索引檔案，載入時不需解析整個字典
+    
+    詞項依 64 位元雜湊排序，查詢時以二分搜尋找到位置後再比對詞項文字；
+    提供與 dict 相同的 in、[]、get 與 items
+    """
+    def __init__(self, hashes: np.ndarray, entries: np.ndarray, names):
+        # entries 每列為 (postings 位移, 位元組長度, 出現的段落數, 詞項文字位移, 詞項文字長度)；
+        # 記憶體映射的陣列轉為一般 ndarray 檢視，避免每次索引都經過 np.memmap
+        self.hashes = np.asarray(hashes)
+        self.entries = np.asarray(entries)
+        self.names = names
+    
+    @classmethod
+    def from_dict(cls, terms: Dict[str, Tuple[int, int, int]]) -> "LexicalTermTable":
+        items = sorted(terms.items(), key=lambda item: lexical_term_hash(item[0]))
+        names = bytearray()
+        entries = np.zeros((len(items), 5), dtype=np.int64)
+        for row, (term, entry) in enumerate(items):
+            encoded = term.encode('utf-8')
+            entries[row] = (*entry, len(names), len(encoded))
+            names += encoded
+        hashes = np.array([lexical_term_hash(term) for term, _ in items], dtype=np.uint64)
+        return cls(hashes, entries, bytes(names))
+    
+    def _find(self, term: str) -> int:
+        key = lexical_term_hash(term)
+        row = int(self.hashes.searchsorted(key))
+        while row < len(self.hashes) and self.hashes[row] == key:
+            offset, length = self.entries[row, 3:]
+            if self.names[offset:offset + length] == term.encode('utf-8'):
+                return row
+            row += 1
+        return -1
+    
+    def get(self, term: str, default=None) -> Optional[Tuple[int, int, int]]:
+        row = self._find(term)
+        if row < 0:
+            return default
+        start, length, df = self.entries[row, :3]
+        return int(start), int(length), int(df)
+    
+    def __contains__(self, term: str) -> bool:
+        return self._find(term) >= 0
+    
+    def __getitem__(self, term: str) -> Tuple[int, int, int]:
+        entry = self.get(term)
+        if entry is None:
+            raise KeyError(term)
+        return entry
+    
+    def __len__(self):
+        return len(self.hashes)
+    
+    def items(self):
+        for (start, length, df, offset, name_length) in self.entries:
+            yield bytes(self.names[offset:offset + name_length]).decode('utf-8'), (int(start), int(length), int(df))
+
+class LexicalSegment:
+    """單一文件的倒排索引區段：每個詞項對應以 varint 壓縮的 (段落編號間隔, 詞頻) 串列"""
+    def __init__(self, terms, postings, doc_lengths: np.ndarray):
+        # terms: 詞項 -> (在 postings 中的位移, 位元組長度, 出現的段落數)；
+        # 新建立的區段為 dict，從索引檔案載入的區段為 LexicalTermTable
+        self.terms = terms
+        self.postings = postings
+        self.doc_lengths = doc_lengths
+    
+    def __len__(self):
+        return len(self.doc_lengths)
+    
+    @classmethod
+    def build(cls, chunks) -> "LexicalSegment":
+        inverted = {}
+        doc_lengths = np.zeros(len(chunks), dtype=np.int32)
+        for local_id, chunk in enumerate(chunks):
+            tokens = lexical_tokens(chunk)
+            doc_lengths[local_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                inverted.setdefault(term, []).append((local_id, tf))
+        
+        blob = bytearray()
+        terms = {}
+        for term, entries in inverted.items():
+            values = []
+            previous = 0
+            for local_id, tf in entries:
+                values.append(local_id - previous)
+                values.append(tf)
+                previous = local_id
+            start = len(blob)
+            blob += encode_varints(values)
+            terms[term] = (start, len(blob) - start, len(entries))
+        return cls(terms, bytes(blob), doc_lengths)
+
+class LexicalIndex:
+    """BM25 詞彙索引，與 file_info 一樣每個文件一個區段，更新文件時只需重建該文件的區段"""
+    def __init__(self, segments: Optional[List[LexicalSegment]] = None, k1: float = 1.2, b: float = 0.75):
+        self.segments = list(segments or [])
+        self.k1 = k1
+        self.b = b
+        self._refresh()
+    
+    def _refresh(self):
+        lengths = [len(segment) for segment in self.segments]
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.total_docs = int(self.offsets[-1])
+        self.doc_lengths = (np.concatenate([segment.doc_lengths for segment in self.segments])
+                            if self.segments else np.zeros(0, dtype=np.int32))
+        self.avgdl = float(self.doc_lengths.mean()) if self.total_docs else 0.0
+    
+    @classmethod
+    def build(cls, course_data, file_info: List[Dict]) -> "LexicalIndex":
+        """依 file_info 的段落範圍為每個文件建立區段"""
+        return cls([
+            LexicalSegment.build(course_data[info["chunk_range"][0]:info["chunk_range"][0] + info["chunk_count"]])
+            for info in file_info
+        ])
+    
+    def copy(self) -> "LexicalIndex":
+        # 區段建立後不會再修改，可以共用
+        return LexicalIndex(self.segments, self.k1, self.b)
+    
+    def splice(self, position: int, segment: Optional[LexicalSegment]):
+        """以 segment 取代第 position 個區段；position 等於區段數量時為附加，segment 為 None 時移除"""
+        if segment is None:
+            del self.segments[position]
+        elif position < len(self.segments):
+            self.segments[position] = segment
+        else:
+            self.segments.append(segment)
+        self._refresh()
+    
+    def search(self, query: str, k: int, deadline: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """以 BM25 計分，返回前 k 個段落索引與分數
+        
+        詞項依出現的段落數由少到多處理；超過 deadline（time.perf_counter() 時間）時
+        略過剩下較常見、鑑別力較低的詞項
+        """
+        if not self.total_docs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        term_stats = []
+        for term in set(lexical_tokens(query)):
+            hits = [(idx, segment, entry) for idx, segment in enumerate(self.segments)
+                    if (entry := segment.terms.get(term)) is not None]
+            if hits:
+                term_stats.append((sum(entry[2] for _, _, entry in hits), term, hits))
+        term_stats.sort(key=lambda item: item[0])
+        
+        ids = []
+        scores = []
+        for df, term, hits in term_stats:
+            if deadline is not None and ids and time.perf_counter() > deadline:
+                break
+            idf = np.log(1 + (self.total_docs - df + 0.5) / (df + 0.5))
+            # 將各區段的 postings 串接後一次解碼，段落編號間隔在每個區段開頭重新起算
+            entries = [entry for _, _, entry in hits]
+            values = decode_varints(b"".join(bytes(segment.postings[start:start + length])
+                                             for _, segment, (start, length, _) in hits))
+            counts = np.array([entry[2] for entry in entries])
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            gaps, tf = values[0::2], values[1::2]
+            cumulative = np.cumsum(gaps)
+            local_ids = cumulative - np.repeat(cumulative[starts] - gaps[starts], counts)
+            global_ids = local_ids + np.repeat(self.offsets[[idx for idx, _, _ in hits]], counts)
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[global_ids] / max(self.avgdl, 1e-9))
+            ids.append(global_ids)
+            scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        totals = np.bincount(np.concatenate(ids), weights=np.concatenate(scores), minlength=self.total_docs)
+        positions, top_scores = VectorIndex._top_k(totals.astype(np.float32), k, None)
+        keep = top_scores > 0
+        return positions[keep], top_scores[keep]
+    
+    def save(self, path: str):
+        """寫成 lexical.bin（所有區段的 postings）、詞項字典、段落長度與 lexical.json
+        
+        詞項字典存成 lexical_hashes.npy、lexical_entries.npy 與 lexical_names.bin，段落長度存成
+        lexical_doc_lengths.npy，載入時全部以記憶體映射開啟；lexical.json 只記錄各區段在這些檔案中的範圍
+        """
+        segments = []
+        tables = [segment.terms if isinstance(segment.terms, LexicalTermTable) else LexicalTermTable.from_dict(segment.terms)
+                  for segment in self.segments]
+        with open(os.path.join(path, 'lexical.bin'), 'wb') as postings_file, \
+                open(os.path.join(path, 'lexical_names.bin'), 'wb') as names_file:
+            base = names_base = terms_start = docs_start = 0
+            for segment, table in zip(self.segments, tables):
+                postings_file.write(segment.postings)
+                names_file.write(table.names)
+                segments.append({
+                    "base": base,
+                    "size": len(segment.postings),
+                    "names_base": names_base,
+                    "names_size": len(table.names),
+                    "terms_start": terms_start,
+                    "term_count": len(table),
+                    "docs_start": docs_start,
+                    "doc_count": len(segment.doc_lengths)
+                })
+                base += len(segment.postings)
+                names_base += len(table.names)
+                terms_start += len(table)
+                docs_start += len(segment.doc_lengths)
+        np.save(os.path.join(path, 'lexical_hashes.npy'),
+                np.concatenate([table.hashes for table in tables]) if tables else np.zeros(0, dtype=np.uint64))
+        np.save(os.path.join(path, 'lexical_entries.npy'),
+                np.concatenate([table.entries for table in tables]) if tables else np.zeros((0, 5), dtype=np.int64))
+        np.save(os.path.join(path, 'lexical_doc_lengths.npy'),
+                np.concatenate([segment.doc_lengths for segment in self.segments]).astype(np.int32)
+                if self.segments else np.zeros(0, dtype=np.int32))
+        with open(os.path.join(path, 'lexical.json'), 'w', encoding='utf-8') as f:
+            json.dump({"k1": self.k1, "b": self.b, "segments": segments}, f, ensure_ascii=False)
+    
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """以記憶體映射方式讀取 postings 與詞項字典，檔案不存在時返回 None"""
+        meta_path = os.path.join(path, 'lexical.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        blob = cls._map_file(os.path.join(path, 'lexical.bin'))
+        if meta["segments"] and "terms" in meta["segments"][0]:
+            # 舊格式的索引世代在 lexical.json 中存放完整的詞項字典
+            return cls([
+                LexicalSegment(
+                    {term: tuple(entry) for term, entry in segment["terms"].items()},
+                    memoryview(blob)[segment["base"]:segment["base"] + segment["size"]],
+                    np.asarray(segment["doc_lengths"], dtype=np.int32)
+                )
+                for segment in meta["segments"]
+            ], meta["k1"], meta["b"])
+        
+        names = cls._map_file(os.path.join(path, 'lexical_names.bin'))
+        hashes = np.load(os.path.join(path, 'lexical_hashes.npy'), mmap_mode='r')
+        entries = np.load(os.path.join(path, 'lexical_entries.npy'), mmap_mode='r')
+        doc_lengths = np.load(os.path.join(path, 'lexical_doc_lengths.npy'), mmap_mode='r')
+        segments = []
+        for segment in meta["segments"]:
+            terms = slice(segment["terms_start"], segment["terms_start"] + segment["term_count"])
+            segments.append(LexicalSegment(
+                LexicalTermTable(hashes[terms], entries[terms],
+                                 memoryview(names)[segment["names_base"]:segment["names_base"] + segment["names_size"]]),
+                memoryview(blob)[segment["base"]:segment["base"] + segment["size"]],
+                doc_lengths[segment["docs_start"]:segment["docs_start"] + segment["doc_count"]]
+            ))
+        return cls(segments, meta["k1"], meta["b"])
+    
+    @staticmethod
+    def _map_file(path: str):
+        if not os.path.getsize(path):
+            return b""
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class StagedCorpus:
+    """寫入端使用的課程資料副本：段落、向量索引與文件資訊
+    
+    上傳與移除文件時先在副本上修改，寫成新的索引世代後才整份換入，查詢不會看到處理到一半的資料
+    """
+    def __init__(self, course_data=None, vector_index: Optional[VectorIndex] = None, file_info: Optional[List[Dict]] = None,
+                 lexical_index: Optional[LexicalIndex] = None):
+        # 從索引載入的段落為唯讀，先轉為串列
+        self.course_data = list(course_data) if course_data is not None else []
+        self.vector_index = vector_index.copy() if vector_index is not None else VectorIndex()
+        self.file_info = [dict(info) for info in file_info] if file_info is not None else []
+        self.lexical_index = lexical_index.copy() if lexical_index is not None else LexicalIndex()
+    
+    def find(self, file_name: str) -> Optional[int]:
+        return next((idx for idx, info in enumerate(self.file_info) if info["file_name"] == file_name), None)
+    
+    def _reindex_file_info(self):
+        """依照文件順序重新計算每個文件的段落範圍"""
+        start_idx = 0
+        for info in self.file_info:
+            info["chunk_range"] = (start_idx, start_idx + info["chunk_count"] - 1)
+            start_idx += info["chunk_count"]
+    
+    def splice(self, position: int, chunks: List[str], embeddings, info: Optional[Dict]):
+        """以新的段落與嵌入向量取代 file_info[position] 對應的範圍
+        
+        position 等於文件數量時為附加；info 為 None 時代表移除該文件
+        """
+        if position < len(self.file_info):
+            start_idx = self.file_info[position]["chunk_range"][0]
+            old_count = self.file_info[position]["chunk_count"]
+        else:
+            start_idx = len(self.course_data)
+            old_count = 0
+        end_idx = start_idx + old_count
+        
+        self.course_data[start_idx:end_idx] = chunks
+        self.vector_index.splice(start_idx, end_idx, embeddings if len(chunks) else [])
+        self.lexical_index.splice(position, LexicalSegment.build(chunks) if info is not None else None)
+        
+        if info is None:
+            del self.file_info[position]
+        elif position < len(self.file_info):
+            self.file_info[position] = info
+        else:
+            self.file_info.append(info)
+        self._reindex_file_info()
+
+# 驗證 ONNX 編碼器與 PyTorch 編碼器一致性、以及比較吞吐量時使用的句子
+ENCODER_CHECK_TEXTS = [
+    "機器學習是讓電腦從資料中學習規律的方法。",
+    "梯度下降法沿著損失函數梯度的反方向更新參數。",
+    "卷積神經網路常用於影像辨識，池化層可以降低特徵圖的維度。",
+    "期中考範圍包含第一章到第五章，請攜帶計算機。",
+    "Backpropagation computes gradients layer by layer using the chain rule.",
+    "The course project is due at the end of week 12.",
+    "Newton's second law states that F = ma.",
+    "CS229 作業三：實作 softmax regression 並回報 cross-entropy loss。",
+    "矩陣乘法不滿足交換律，但滿足結合律。",
+    "過擬合時可以使用正規化、dropout 或提早停止訓練。",
+    "Transformer 以自注意力機制取代循環結構，能平行處理整個序列。",
+    "請說明監督式學習與非監督式學習的差異，並各舉一個例子。" * 8,
+]
+
+# ENCODER_BACKEND 可選的 ONNX 後端與其模型檔案
+ONNX_MODEL_FILES = {"onnx": "model.onnx", "onnx-int8": "model.int8.onnx"}
+
+class OnnxEncoder:
+    """以 ONNX Runtime 執行匯出的 transformer，平均池化與正規化以 numpy 計算，輸出與 SentenceTransformer 相容"""
+    def __init__(self, export_dir: str, model_file: str, threads: int = 0):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        with open(os.path.join(export_dir, 'export.json'), encoding='utf-8') as f:
+            self.export_info = json.load(f)
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(export_dir, model_file), options, providers=['CPUExecutionProvider']
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        self.max_seq_length = self.export_info["max_seq_length"]
+        self.normalize = self.export_info["normalize"]
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.export_info["dim"])
+    
+    def encode(self, texts: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """依長度排序後分批編碼，減少補齊的 token"""
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        vectors = np.empty((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            batch_idx = order[start:start + batch_size]
+            encoded = self.tokenizer([texts[i] for i in batch_idx], padding=True, truncation=True,
+                                     max_length=self.max_seq_length, return_tensors='np')
+            mask = encoded['attention_mask'].astype(np.int64)
+            hidden = self.session.run(None, {
+                'input_ids': encoded['input_ids'].astype(np.int64),
+                'attention_mask': mask
+            })[0]
+            # 與 sentence-transformers 的 Pooling(mean) 相同：只平均非補齊位置的 token
+            weights = mask[..., None].astype(np.float32)
+            vectors[batch_idx] = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+        return VectorIndex.normalize(vectors) if self.normalize else vectors
+
+def _cosine_agreement(reference: np.ndarray, vectors: np.ndarray) -> Dict[str, float]:
+    cosines = np.sum(VectorIndex.normalize(reference) * VectorIndex.normalize(vectors), axis=1)
+    return {"min_cosine": round(float(cosines.min()), 6), "mean_cosine": round(float(cosines.mean()), 6)}
+
+def _encode_throughput(encoder, texts: List[str], rounds: int = 3) -> float:
+    """每秒編碼的句子數（取多輪中最快的一輪）"""
+    encoder.encode(texts[:2])
+    best = float('inf')
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        encoder.encode(texts)
+        best = min(best, time.perf_counter() - start_time)
+    return round(len(texts) / best, 1)
+
+def export_onnx_encoder(model_name: str, export_dir: str) -> Dict[str, Any]:
+    """將 SentenceTransformer 的 transformer 匯出為 ONNX（fp32 與動態量化 int8），並與 PyTorch 的輸出比較
+    
+    匯出需要 torch；之後的啟動只需 onnxruntime 與 tokenizer。比較結果與吞吐量寫入 export.json
+    """
+    import inspect
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    
+    model = SentenceTransformer(model_name, device='cpu')
+    transformer, pooling = model[0], model[1]
+    if type(pooling).__name__ != 'Pooling' or not pooling.pooling_mode_mean_tokens:
+        raise ValueError(f"模型 {model_name} 不是使用平均池化，不支援匯出為 ONNX")
+    
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+        
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+    
+    tmp_dir = f"{export_dir}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_dir)
+    try:
+        sample = transformer.tokenizer(["匯出 export"], return_tensors='pt')
+        with torch.no_grad():
+            torch.onnx.export(
+                TokenEmbeddings(transformer.auto_model.eval()),
+                (sample['input_ids'], sample['attention_mask']),
+                os.path.join(tmp_dir, 'model.onnx'),
+                input_names=['input_ids', 'attention_mask'],
+                output_names=['token_embeddings'],
+                dynamic_axes={
+                    'input_ids': {0: 'batch', 1: 'sequence'},
+                    'attention_mask': {0: 'batch', 1: 'sequence'},
+                    'token_embeddings': {0: 'batch', 1: 'sequence'}
+                },
+                opset_version=14,
+                # 較新的 torch 預設使用 dynamo 匯出器，這裡沿用支援 dynamic_axes 的 TorchScript 匯出器
+                **({'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {})
+            )
+        quantize_dynamic(os.path.join(tmp_dir, 'model.onnx'), os.path.join(tmp_dir, 'model.int8.onnx'),
+                         weight_type=QuantType.QInt8)
+        transformer.tokenizer.save_pretrained(tmp_dir)
+        info = {
+            "model_name": model_name,
+            "dim": model.get_sentence_embedding_dimension(),
+            "max_seq_length": model.max_seq_length,
+            "normalize": any(type(module).__name__ == 'Normalize' for module in model),
+            "created_at": time.time()
+        }
+        with open(os.path.join(tmp_dir, 'export.json'), 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False)
+        
+        # 以固定的句子比較各後端與 PyTorch 的餘弦相似度，並量測吞吐量
+        texts = ENCODER_CHECK_TEXTS * 4
+        reference = model.encode(ENCODER_CHECK_TEXTS)
+        info["agreement"] = {}
+        info["throughput"] = {"torch": _encode_throughput(model, texts)}
+        for backend, model_file in ONNX_MODEL_FILES.items():
+            encoder = OnnxEncoder(tmp_dir, model_file)
+            info["agreement"][backend] = _cosine_agreement(reference, encoder.encode(ENCODER_CHECK_TEXTS))
+            info["throughput"][backend] = _encode_throughput(encoder, texts)
+        with open(os.path.join(tmp_dir, 'export.json'), 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False)
+        shutil.rmtree(export_dir, ignore_errors=True)
+        os.rename(tmp_dir, export_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(f"已匯出 ONNX 編碼器: 一致性 {info['agreement']}，每秒句數 {info['throughput']}")
+    return info
+
+def load_encoder(model_name: str, backend: str = "torch"):
+    """依 ENCODER_BACKEND 建立編碼器
+    
+    編碼器需提供 encode(texts) -> np.ndarray、tokenizer 與 get_sentence_embedding_dimension()；
+    "torch" 直接使用 SentenceTransformer，"onnx" 與 "onnx-int8" 第一次使用時從 SentenceTransformer 匯出。
+    ONNX 輸出與 PyTorch 的最低餘弦相似度低於 ENCODER_MIN_COSINE，或未安裝 onnxruntime、匯出與載入失敗時
+    改用 PyTorch，確保與既有索引相容且服務不會沒有編碼器
+    """
+    if backend != "torch":
+        if backend not in ONNX_MODEL_FILES:
+            raise ValueError(f"不支援的編碼器後端: {backend}")
+        try:
+            export_dir = os.path.join(os.getenv('CACHE_DIR', 'cache'), 'onnx', re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+            # 多個工作行程同時啟動時只由一個行程匯出
+            with FileLock(export_dir + ".lock").acquire():
+                if not os.path.exists(os.path.join(export_dir, 'export.json')):
+                    export_onnx_encoder(model_name, export_dir)
+            encoder = OnnxEncoder(export_dir, ONNX_MODEL_FILES[backend], threads=int(os.getenv('ONNX_THREADS', '0')))
+            min_cosine = encoder.export_info["agreement"][backend]["min_cosine"]
+        except Exception as e:
+            print(f"無法使用 {backend} 編碼器: {str(e)}，改用 PyTorch")
+        else:
+            if min_cosine >= float(os.getenv('ENCODER_MIN_COSINE', '0.99')):
+                return encoder
+            print(f"{backend} 編碼器與 PyTorch 的最低餘弦相似度只有 {min_cosine}，改用 PyTorch")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+class BackgroundModelLoader:
+    """在背景執行緒載入編碼器並做一次暖機編碼，讓服務不必等待模型載入就能開始接受連線
+    
+    需要模型的呼叫會等待載入完成；載入失敗時拋出錯誤
+    """
+    def __init__(self, model_name: str, backend: str = "torch"):
+        self.model_name = model_name
+        self.backend = backend
+        self.status = "loading"
+        self.error = None
+        self.load_seconds = None
+        self.warmup_ms = None
+        self.ready_at = None
+        self._model = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._load, name="rag-model-loader", daemon=True)
+        self._thread.start()
+    
+    def _load(self):
+        start_time = time.perf_counter()
+        try:
+            model = load_encoder(self.model_name, self.backend)
+            self.load_seconds = time.perf_counter() - start_time
+            # 第一次編碼會初始化執行緒池與運算核心，先做一次避免由第一個查詢承擔
+            warmup_start = time.perf_counter()
+            model.encode(["warmup 暖機"])
+            self.warmup_ms = (time.perf_counter() - warmup_start) * 1000
+            self._model = model
+            self.status = "ready"
+            self.ready_at = time.perf_counter()
+            print(f"嵌入模型 {self.model_name}（{self.active_backend}）已載入，耗時 {self.load_seconds:.1f} 秒，暖機編碼 {self.warmup_ms:.0f} 毫秒")
+        except Exception as e:
+            self.error = str(e)
+            self.status = "failed"
+            print(f"載入嵌入模型時出錯: {str(e)}")
+        finally:
+            self._done.set()
+    
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+    
+    @property
+    def active_backend(self) -> Optional[str]:
+        """實際使用的後端；ONNX 與 PyTorch 不一致而改用 PyTorch 時與設定的後端不同"""
+        if self._model is None:
+            return None
+        return self.backend if isinstance(self._model, OnnxEncoder) else "torch"
+    
+    def get(self):
+        """取得模型，尚未載入完成時等待"""
+        self._done.wait()
+        if self._model is None:
+            raise RuntimeError(f"嵌入模型載入失敗: {self.error}")
+        return self._model
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model_name": self.model_name,
+            "backend": self.backend,
+            "active_backend": self.active_backend,
+            "status": self.status,
+            "error": self.error,
+            "import_seconds": round(APP_READY_AT - IMPORT_STARTED_AT, 3) if APP_READY_AT else None,
+            "model_load_seconds": round(self.load_seconds, 3) if self.load_seconds is not None else None,
+            "warmup_ms": round(self.warmup_ms, 1) if self.warmup_ms is not None else None,
+            "ready_after_seconds": round(self.ready_at - IMPORT_STARTED_AT, 3) if self.ready_at else None,
+            "export": getattr(self._model, 'export_info', None)
+        }
+
+class EmbeddingBatcher:
+    """動態微批次編碼：收集短時間內同時到達的編碼請求，合併成一次 encode 呼叫後再分發結果
+    
+    等待時間上限為 max_wait_ms，或累積到 max_batch_size 個段落時立即編碼；
+    本身已達批次大小的請求（例如上傳時的大量段落）直接編碼，不進入佇列。
+    非同步的查詢路徑以 submit 取得 Future 後等待，等待中的請求不佔用執行緒池的執行緒，批次大小只受負載限制
+    """
+    def __init__(self, encode_fn, max_batch_size: int = 32, max_wait_ms: float = 5.0, max_queue_size: int = 1024):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.requests = 0
+        self.direct_requests = 0
+        self.batches = 0
+        self.batched_texts = 0
+        self.largest_batch = 0
+        self.total_wait = 0.0
+    
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """將編碼請求放入佇列並等待批次結果"""
+        if len(texts) >= self.max_batch_size:
+            with self._lock:
+                self.direct_requests += 1
+            return self.encode_fn(texts)
+        
+        return self.submit(texts).result()
+    
+    def submit(self, texts: List[str], block: bool = True) -> Future:
+        """將編碼請求放入佇列，返回批次完成時設定結果的 Future；block 為 False 且佇列已滿時拋出 queue.Full"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((texts, future, time.perf_counter()), block=block)
+        return future
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            
+            started = time.perf_counter()
+            texts = [text for item_texts, _, _ in batch for text in item_texts]
+            try:
+                vectors = self.encode_fn(texts)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            
+            with self._lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self.batched_texts += len(texts)
+                self.largest_batch = max(self.largest_batch, len(texts))
+                self.total_wait += sum(started - enqueued for _, _, enqueued in batch)
+            
+            offset = 0
+            for item_texts, future, _ in batch:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+    
+    def stats(self) -> Dict[str, Any]:
+        """回傳佇列深度、批次大小與等待時間統計"""
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "requests": self.requests,
+            "direct_requests": self.direct_requests,
+            "batches": self.batches,
+            "avg_batch_size": self.batched_texts / self.batches if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "avg_wait_ms": self.total_wait / self.requests * 1000 if self.requests else 0.0
+        }
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """將事件格式化為 Server-Sent Events 訊息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+CJK_PATTERN = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估計文字的 token 數：中日韓文字約一字一個 token，其他文字約四個字元一個 token"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """粗略估計訊息的 token 數"""
+    return sum(estimate_text_tokens(message.get("content", "")) + 4 for message in messages)
+
+class TextChunker:
+    """依句子標點（。！？；）與 token 長度切分文本的段落切分器，適用於幾乎沒有空格的中文教材
+    
+    逐句串流處理，不建立整份文本的詞彙串列；句子以 count_tokens 批次計算 token 數後
+    打包成不超過 max_tokens 的段落，相鄰段落重疊最多 overlap_tokens 個 token 的完整句子，
+    單一句子超過上限時依長度硬切
+    """
+    # 句末標點（含其後的引號、括號）、英文句點後的空白，以及空行都視為句子邊界
+    SENTENCE_BOUNDARY = re.compile(r'[。！？；!?;]+[」』”’"\'）)]*|\.(?=\s)|\n\s*\n')
+    
+    def __init__(self, max_tokens: int = 128, overlap_tokens: int = 32,
+                 count_tokens: Optional[Callable[[List[str]], List[int]]] = None, batch_size: int = 256):
+        self.max_tokens = max(1, max_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.max_tokens // 2))
+        self.count_tokens = count_tokens or (lambda texts: [estimate_text_tokens(text) for text in texts])
+        self.batch_size = batch_size
+    
+    def iter_sentences(self, text: str):
+        """逐一產生句子，並將句子內的換行與連續空白合併為單一空格"""
+        start = 0
+        for match in self.SENTENCE_BOUNDARY.finditer(text):
+            sentence = ' '.join(text[start:match.end()].split())
+            if sentence:
+                yield sentence
+            start = match.end()
+        sentence = ' '.join(text[start:].split())
+        if sentence:
+            yield sentence
+    
+    def _counted_sentences(self, text: str):
+        """以批次計算 token 數，產生 (句子, token 數)"""
+        batch = []
+        for sentence in self.iter_sentences(text):
+            batch.append(sentence)
+            if len(batch) >= self.batch_size:
+                yield from zip(batch, self.count_tokens(batch))
+                batch = []
+        if batch:
+            yield from zip(batch, self.count_tokens(batch))
+    
+    def _split_long(self, sentence: str, tokens: int):
+        """將超過上限的句子依長度平均切開，英文盡量在空白處斷開"""
+        pieces = -(-tokens // self.max_tokens)
+        piece_len = -(-len(sentence) // pieces)
+        start = 0
+        while start < len(sentence):
+            end = min(start + piece_len, len(sentence))
+            if end < len(sentence) and not CJK_PATTERN.match(sentence[end - 1]):
+                space = sentence.rfind(' ', start + piece_len // 2, end)
+                if space > start:
+                    end = space
+            piece = sentence[start:end].strip()
+            if piece:
+                yield piece, max(1, tokens * len(piece) // len(sentence))
+            start = end
+    
+    @staticmethod
+    def _join(sentences: List[str]) -> str:
+        """中日韓文字之間直接相連，其他文字以空格分隔"""
+        text = ""
+        for sentence in sentences:
+            if text and not (CJK_PATTERN.match(text[-1]) and CJK_PATTERN.match(sentence[0])):
+                text += " "
+            text += sentence
+        return text
+    
+    def iter_chunks(self, text: str):
+        """逐一產生段落"""
+        current = []
+        current_tokens = 0
+        for sentence, tokens in self._counted_sentences(text):
+            parts = self._split_long(sentence, tokens) if tokens > self.max_tokens else [(sentence, tokens)]
+            for part, part_tokens in parts:
+                if current and current_tokens + part_tokens > self.max_tokens:
+                    yield self._join([sentence for sentence, _ in current])
+                    # 保留結尾的完整句子作為下一個段落的重疊部分
+                    overlap = []
+                    overlap_tokens = 0
+                    for previous in reversed(current[1:]):
+                        if overlap_tokens + previous[1] > self.overlap_tokens or overlap_tokens + previous[1] + part_tokens > self.max_tokens:
+                            break
+                        overlap.insert(0, previous)
+                        overlap_tokens += previous[1]
+                    current = overlap
+                    current_tokens = overlap_tokens
+                current.append((part, part_tokens))
+                current_tokens += part_tokens
+        if current:
+            yield self._join([sentence for sentence, _ in current])
+
+def parse_rate_limit_duration(value: Optional[str]) -> Optional[float]:
+    """解析 "7.66s"、"2m59.56s"、"120ms" 或純秒數格式的時間長度"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    matches = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not matches:
+        return None
+    return sum(float(number) * units[unit] for number, unit in matches)
+
+class GroqRateLimiter:
+    """整個行程共用的 Groq 速率限制器，同時追蹤每分鐘請求數與 token 數兩個令牌桶
+    
+    呼叫端依先到先服務的順序排隊；回應中的 Retry-After 與 x-ratelimit-* 標頭會同步修正剩餘額度，
+    遇到 429 時所有呼叫端一起暫停，而不是各自盲目等待
+    """
+    def __init__(self, requests_per_minute: int = 30, tokens_per_minute: int = 6000,
+                 backoff_base: float = 2.0, backoff_max: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._request_budget = float(requests_per_minute)
+        self._token_budget = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = None
+        self.calls = 0
+        self.waited_calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+    
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._request_budget = min(self.requests_per_minute, self._request_budget + elapsed * self.requests_per_minute / 60)
+        self._token_budget = min(self.tokens_per_minute, self._token_budget + elapsed * self.tokens_per_minute / 60)
+    
+    async def acquire(self, tokens: int) -> float:
+        """等待直到請求數與 token 額度都足夠，返回等待的秒數"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        start = time.monotonic()
+        needed = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if self._request_budget < 1:
+                    wait = max(wait, (1 - self._request_budget) * 60 / self.requests_per_minute)
+                if self._token_budget < needed:
+                    wait = max(wait, (needed - self._token_budget) * 60 / self.tokens_per_minute)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._request_budget -= 1
+            self._token_budget -= needed
+        
+        waited = time.monotonic() - start
+        self.calls += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited > 0.001:
+            self.waited_calls += 1
+        return waited
+    
+    def update_from_headers(self, headers):
+        """依據 x-ratelimit-* 標頭修正剩餘額度"""
+        now = time.monotonic()
+        self._refill(now)
+        for kind, budget_attr in (("requests", "_request_budget"), ("tokens", "_token_budget")):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                continue
+            setattr(self, budget_attr, min(getattr(self, budget_attr), remaining))
+            reset = parse_rate_limit_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining <= 0 and reset:
+                self._blocked_until = max(self._blocked_until, now + reset)
+    
+    def register_throttle(self, headers, attempt: int) -> float:
+        """收到 429 時暫停所有呼叫端：優先採用 Retry-After，否則使用帶隨機抖動的指數退避"""
+        self.throttled += 1
+        delay = parse_rate_limit_duration(headers.get("retry-after"))
+        if delay is None:
+            delay = self.backoff_delay(attempt)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        return delay
+    
+    def backoff_delay(self, attempt: int) -> float:
+        return min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+    
+    def reconcile(self, estimated: int, actual: Optional[int]):
+        """以回應中的實際 token 用量修正預估值"""
+        if actual is not None:
+            self._token_budget -= actual - min(estimated, self.tokens_per_minute)
+    
+    def stats(self) -> Dict[str, Any]:
+        """回傳目前額度與等待時間統計"""
+        self._refill(time.monotonic())
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "request_budget": round(self._request_budget, 2),
+            "token_budget": round(self._token_budget, 2),
+            "blocked_for_seconds": round(max(0.0, self._blocked_until - time.monotonic()), 2),
+            "calls": self.calls,
+            "waited_calls": self.waited_calls,
+            "throttled": self.throttled,
+            "avg_wait_ms": self.total_wait / self.calls * 1000 if self.calls else 0.0,
+            "max_wait_ms": self.max_wait * 1000
+        }
+
+class AnswerCache:
+    """語意回答快取：以查詢向量的相似度加上檢索到的段落組合為鍵，重複的問題不需再次呼叫 LLM
+    
+    只有檢索到完全相同的段落、且查詢向量的餘弦相似度達到 similarity_threshold 時才算命中；
+    以 LRU 與 TTL 限制大小，課程資料變更時由 RAGSystem 清空
+    """
+    def __init__(self, similarity_threshold: float = 0.95, max_entries: int = 1000, ttl_seconds: float = 3600):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._by_chunks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+    
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_chunks.get(entry["chunk_ids"])
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_chunks[entry["chunk_ids"]]
+    
+    def lookup(self, query_vector, chunk_ids: Tuple[int, ...]) -> Optional[Dict[str, Any]]:
+        """尋找相同段落組合下最相似的已快取問題，返回其回答與來源"""
+        if self.max_entries <= 0:
+            return None
+        query_vector = VectorIndex.normalize(np.asarray(query_vector).reshape(-1))
+        now = time.time()
+        with self._lock:
+            best_id, best_score = None, self.similarity_threshold
+            for entry_id in list(self._by_chunks.get(chunk_ids, ())):
+                entry = self._entries[entry_id]
+                if now - entry["created"] > self.ttl_seconds:
+                    self._remove(entry_id)
+                    self.evictions += 1
+                    continue
+                score = float(entry["vector"] @ query_vector)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            self.hits += 1
+            self.saved_seconds += entry["latency"]
+            return entry
+    
+    def store(self, query_vector, chunk_ids: Tuple[int, ...], answer: str, sources: str, latency: float):
+        """保存 LLM 回答，超過上限時淘汰最久未使用的項目"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            entry_id = uuid.uuid4().hex
+            self._entries[entry_id] = {
+                "vector": VectorIndex.normalize(np.asarray(query_vector).reshape(-1)),
+                "chunk_ids": chunk_ids,
+                "answer": answer,
+                "sources": sources,
+                "latency": latency,
+                "created": time.time()
+            }
+            self._by_chunks.setdefault(chunk_ids, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def clear(self):
+        """課程資料變更時清空所有快取的回答"""
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._by_chunks.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """回傳命中率與節省的 LLM 時間"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "similarity_threshold": self.similarity_threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "avg_saved_ms": self.saved_seconds / self.hits * 1000 if self.hits else 0.0
+        }
+
+class SingleFlight:
+    """合併進行中的相同請求：相同鍵的並行呼叫共用同一次上游請求與其結果"""
+    def __init__(self):
+        self._inflight = {}
+        self.leaders = 0
+        self.collapsed = 0
+    
+    async def do(self, key: str, fn):
+        """若相同鍵的請求正在進行則等待其結果，否則執行 fn() 並讓後來者共用"""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.collapsed += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield 讓單一呼叫端被取消時不會中斷其他等待者共用的請求
+        return await asyncio.shield(task)
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.leaders + self.collapsed
+        return {
+            "inflight": len(self._inflight),
+            "upstream_calls": self.leaders,
+            "collapsed_calls": self.collapsed,
+            "collapse_ratio": self.collapsed / total if total else 0.0
+        }
+
+class IngestionJob:
+    """背景上傳處理工作的狀態與各階段進度"""
+    def __init__(self, file_names: List[str], mode: str, course_id: str = DEFAULT_COURSE_ID,
+                 state_dir: Optional[str] = None):
+        self.job_id = str(uuid.uuid4())
+        self.file_names = file_names
+        self.mode = mode
+        self.course_id = course_id
+        # queued -> extracting（提取與編碼）-> indexing -> completed / failed
+        self.status = "queued"
+        self.progress = {
+            "files_total": len(file_names),
+            "files_extracted": 0,
+            "pages_total": 0,
+            "pages_extracted": 0,
+            "ocr_pages_total": 0,
+            "ocr_pages_done": 0,
+            "chunks_total": 0,
+            "chunks_embedded": 0
+        }
+        self.extraction = []
+        self.message = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        # 狀態同時寫入此檔案，讓其他工作行程收到的查詢也能讀取進度
+        self.state_path = os.path.join(state_dir, f"{self.job_id}.json") if state_dir else None
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+        self.save_state()
+    
+    def advance(self, field: str, amount: int = 1):
+        """累加某個進度欄位，可從工作執行緒呼叫"""
+        with self._lock:
+            self.progress[field] = self.progress.get(field, 0) + amount
+        if time.time() - self._saved_at > 0.5:
+            self.save_state()
+    
+    def save_state(self):
+        if self.state_path is None:
+            return
+        self._saved_at = time.time()
+        tmp_path = f"{self.state_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            print(f"寫入上傳工作狀態時出錯: {str(e)}")
+    
+    def set_status(self, status: str, message: Optional[str] = None, error: Optional[str] = None):
+        with self._lock:
+            self.status = status
+            if message is not None:
+                self.message = message
+            if error is not None:
+                self.error = error
+            if status in ("completed", "failed"):
+                self.finished_at = time.time()
+        self.save_state()
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+    
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            end_time = self.finished_at or time.time()
+            return {
+                "job_id": self.job_id,
+                "status": self.status,
+                "mode": self.mode,
+                "course_id": self.course_id,
+                "file_names": self.file_names,
+                "progress": dict(self.progress),
+                "extraction": list(self.extraction),
+                "message": self.message,
+                "error": self.error,
+                "elapsed_seconds": round(end_time - self.created_at, 3)
+            }
+
+def extract_pdf_page_range(pdf_content: bytes, start: int, end: int) -> List[Tuple[str, float]]:
+    """直接從記憶體中的 PDF 提取 [start, end) 頁的文字，返回每頁的 (文字, 耗時秒數)
+    
+    定義在模組層級，讓行程池的工作行程可以呼叫
+    """
+    import PyPDF2
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
+    results = []
+    for page_num in range(start, end):
+        page_start = time.perf_counter()
+        page_text = pdf_reader.pages[page_num].extract_text() or ""
+        results.append((page_text, time.perf_counter() - page_start))
+    return results
+
+# 行程池工作行程中的 PDF 內容，由 _init_pdf_worker 設定
+_worker_pdf_content = None
+
+def _init_pdf_worker(pdf_content: bytes):
+    """行程池工作行程的初始化函數；以 fork 建立的工作行程直接繼承 PDF 內容，工作只需傳送頁面範圍"""
+    global _worker_pdf_content
+    _worker_pdf_content = pdf_content
+
+def _extract_worker_page_range(start: int, end: int) -> List[Tuple[str, float]]:
+    return extract_pdf_page_range(_worker_pdf_content, start, end)
+
+def _hash_pdf_object(obj, digest, seen: set):
+    """將 PDF 物件（含引用的串流與資源）的內容寫入雜湊，不包含物件編號，因此不同檔案中相同的頁面會得到相同的雜湊"""
+    import PyPDF2
+    if isinstance(obj, PyPDF2.generic.IndirectObject):
+        ref = (obj.idnum, obj.generation)
+        if ref in seen:
+            digest.update(b"R")
+            return
+        seen.add(ref)
+        obj = obj.get_object()
+    if isinstance(obj, PyPDF2.generic.DictionaryObject):
+        digest.update(b"<<")
+        for key in sorted(obj.keys()):
+            # /Parent 指向頁面樹，與頁面內容無關
+            if key == "/Parent":
+                continue
+            digest.update(key.encode('utf-8'))
+            _hash_pdf_object(obj.raw_get(key), digest, seen)
+        if isinstance(obj, PyPDF2.generic.StreamObject):
+            digest.update(b"stream")
+            digest.update(obj._data or b"")
+        digest.update(b">>")
+    elif isinstance(obj, PyPDF2.generic.ArrayObject):
+        digest.update(b"[")
+        for item in obj:
+            _hash_pdf_object(item, digest, seen)
+        digest.update(b"]")
+    else:
+        digest.update(repr(obj).encode('utf-8'))
+
+def pdf_page_hashes(pdf_content: bytes, page_numbers: List[int]) -> Dict[int, str]:
+    """計算指定頁面（頁碼從 1 開始）的內容雜湊，涵蓋頁面內容串流與其使用的圖像、字型等資源"""
+    import PyPDF2
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
+    hashes = {}
+    for page_number in page_numbers:
+        digest = hashlib.sha256()
+        _hash_pdf_object(pdf_reader.pages[page_number - 1], digest, set())
+        hashes[page_number] = digest.hexdigest()
+    return hashes
 
 class RAGSystem:
-    def __init__(self, model_name: str = 'all-mpnet-base-v2'):
-        """初始化 RAG 系統"""
-        self.model = SentenceTransformer(model_name)
+    # 每個課程各自擁有的索引狀態；其餘屬性（編碼模型、快取、執行緒池、速率限制器、對話等）由所有課程共用
+    COURSE_ATTRIBUTES = frozenset({
+        "course_id", "data_dir", "index_dir", "current_session", "course_data", "vector_index",
+        "lexical_index", "file_info", "answer_cache", "resident", "_ingest_lock", "_index_lock",
+        "_index_file_lock", "_index_checked_at"
+    })
+    
+    def __init__(self, model_name: str = 'all-mpnet-base-v2', course_id: str = DEFAULT_COURSE_ID,
+                 shared: Optional["RAGSystem"] = None):
+        """初始化 RAG 系統
+        
+        shared 為另一個課程的 RAGSystem 時共用其編碼模型與服務元件，只建立本課程的索引狀態
+        """
+        if shared is not None:
+            self.__dict__.update({name: value for name, value in shared.__dict__.items() if name not in self.COURSE_ATTRIBUTES})
+        else:
+            self._init_services(model_name)
+        
+        self.course_id = course_id
+        # 目錄在第一次寫入索引時才建立，只查詢不存在的課程不會在磁碟上留下目錄
+        self.data_dir = course_data_dir(course_id)
+        self.index_dir = os.path.join(self.data_dir, "index")
+        # 目前使用中的索引世代路徑
+        self.current_session = None
         self.course_data = []
-        self.embeddings = []
+        self.vector_index = VectorIndex()
+        self.lexical_index = LexicalIndex()
+        # 每個文件的資訊（檔名、內容雜湊、段落範圍），順序與 course_data 一致
+        self.file_info = []
+        # 常見問題的語意回答快取，課程資料變更時清空
+        self.answer_cache = AnswerCache(
+            similarity_threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95')),
+            max_entries=int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '1000')),
+            ttl_seconds=float(os.getenv('ANSWER_CACHE_TTL', '3600'))
+        )
+        # ingest_lock 確保同一時間只有一個寫入操作；index_lock 保護段落與向量的一致性
+        self._ingest_lock = threading.Lock()
+        self._index_lock = threading.RLock()
+        # 多個工作行程之間序列化同一課程的索引寫入；放在 index_dir 之外，清除資料時不會被刪除
+        self._index_file_lock = FileLock(self.index_dir + ".lock")
+        self._index_checked_at = time.monotonic()
+        # 索引是否載入在記憶體中；被 CorpusRegistry 移出後於下次使用時重新載入
+        self.resident = False
+        self.ensure_loaded()
+    
+    def _init_services(self, model_name: str):
+        """建立所有課程共用的元件"""
+        # 延遲建立的 HTTP 連線池由第一個 RAGSystem 持有
+        self._root = self
+        self.model_name = model_name
+        # 模型在背景載入，索引與其他元件不需等待；第一次需要編碼時才等待載入完成
+        self.model_loader = BackgroundModelLoader(model_name, os.getenv('ENCODER_BACKEND', 'torch'))
+        # 合併同時到達的編碼請求，提高 CPU 上的編碼吞吐量
+        self.embedding_batcher = EmbeddingBatcher(
+            lambda texts: self.model.encode(texts),
+            max_batch_size=int(os.getenv('EMBED_BATCH_MAX_SIZE', '32')),
+            max_wait_ms=float(os.getenv('EMBED_BATCH_MAX_WAIT_MS', '5')),
+            max_queue_size=int(os.getenv('EMBED_QUEUE_MAX', '1024'))
+        )
+        # 跨工作階段共用的嵌入向量快取，不會被 clear_all_data 清除
+        self.embedding_cache = EmbeddingCache(
+            os.path.join(os.getenv('CACHE_DIR', 'cache'), 'embeddings'),
+            model_name,
+            max_entries=int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '200000')),
+            touch_interval=float(os.getenv('EMBEDDING_CACHE_TOUCH_INTERVAL', '30'))
+        )
+        # 混合檢索：以倒數排名融合（RRF）結合向量與 BM25 的排名，RETRIEVAL_MODE 設為 dense 時只用向量檢索
+        self.retrieval_mode = os.getenv('RETRIEVAL_MODE', 'hybrid')
+        self.hybrid_candidates = int(os.getenv('HYBRID_CANDIDATES', '20'))
+        self.hybrid_rrf_k = float(os.getenv('HYBRID_RRF_K', '60'))
+        self.hybrid_latency_budget = float(os.getenv('HYBRID_LATENCY_BUDGET_MS', '30')) / 1000
         self.api_key = os.getenv('GROQ_API_KEY')
-        self.data_dir = "uploads"
-        self.last_api_call = 0  # 記錄上次 API 呼叫時間
-        os.makedirs(self.data_dir, exist_ok=True)
-        self.current_session = None
-        # 保存所有對話的字典
-        self.conversations = {}
+        # 所有 Groq 呼叫共用的速率限制器
+        self.rate_limiter = GroqRateLimiter(
+            requests_per_minute=int(os.getenv('GROQ_RPM_LIMIT', '30')),
+            tokens_per_minute=int(os.getenv('GROQ_TPM_LIMIT', '6000')),
+            backoff_base=float(os.getenv('GROQ_BACKOFF_BASE', '2')),
+            backoff_max=float(os.getenv('GROQ_BACKOFF_MAX', '60'))
+        )
+        # 所有課程共用的對話存放區，閒置或超出上限的對話寫入磁碟
+        self.conversations = ConversationStore(
+            os.path.join(os.getenv('CACHE_DIR', 'cache'), 'conversations'),
+            max_resident=int(os.getenv('CONVERSATION_MAX_RESIDENT', '1000')),
+            ttl_seconds=float(os.getenv('CONVERSATION_TTL', '1800')),
+            retention_seconds=float(os.getenv('CONVERSATION_RETENTION_DAYS', '30')) * 86400
+        )
+        # 批次問答時同時進行的 LLM 呼叫數量
+        self.batch_query_concurrency = int(os.getenv('BATCH_QUERY_CONCURRENCY', '4'))
+        # 編碼、PDF 處理等 CPU 密集工作在此執行緒池中進行，避免阻塞事件迴圈
+        cpu_workers = int(os.getenv('CPU_WORKERS', str(min(4, os.cpu_count() or 1))))
+        self.cpu_executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="rag-cpu")
+        # PDF 逐頁解析的行程池，每份大型 PDF 各自建立；同一時間只有一個行程池，工作行程總數不超過 pdf_workers
+        self._pdf_pool_lock = threading.Lock()
+        self.pdf_workers = int(os.getenv('PDF_WORKERS', str(os.cpu_count() or 1)))
+        self.pdf_pages_per_task = int(os.getenv('PDF_PAGES_PER_TASK', '16'))
+        # 依句子標點與模型 tokenizer 長度切分段落
+        self.chunker = TextChunker(
+            max_tokens=int(os.getenv('CHUNK_MAX_TOKENS', '128')),
+            overlap_tokens=int(os.getenv('CHUNK_OVERLAP_TOKENS', '32')),
+            count_tokens=self._count_tokens
+        )
+        self._token_counter = None
+        # 上傳時每批編碼的段落數，用於回報背景工作的進度
+        self.embed_progress_batch = int(os.getenv('EMBED_PROGRESS_BATCH', '256'))
+        # 上傳工作同時提取的文件數，預設保留一個 CPU 執行緒給已提取文件的編碼
+        self.ingest_concurrency = int(os.getenv('INGEST_CONCURRENCY', str(max(1, cpu_workers - 1))))
+        # 上傳工作的提取與編碼在獨立的執行緒池中進行，不佔用查詢使用的 cpu_executor
+        self.ingest_executor = ThreadPoolExecutor(max_workers=max(1, self.ingest_concurrency), thread_name_prefix="rag-ingest")
+        # OCR 設定：頁面以小視窗逐段渲染，OCR_MAX_MEMORY_MB 限制所有文件同時存在記憶體中的頁面圖像
+        self.ocr_dpi = int(os.getenv('OCR_DPI', '300'))
+        self.ocr_lang = os.getenv('OCR_LANG', 'chi_tra+eng')
+        self.ocr_max_memory_mb = float(os.getenv('OCR_MAX_MEMORY_MB', '512'))
+        # 同一時間只有一個渲染視窗，並行提取多份文件時記憶體上限仍為 OCR_MAX_MEMORY_MB
+        self._ocr_window_lock = threading.Lock()
+        # 跨工作階段共用的 OCR 結果快取，不會被 clear_all_data 清除
+        self.ocr_cache = OCRCache(
+            os.path.join(os.getenv('CACHE_DIR', 'cache'), 'ocr'),
+            max_entries=int(os.getenv('OCR_CACHE_MAX_ENTRIES', '100000'))
+        )
+        self.ocr_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('OCR_WORKERS', str(os.cpu_count() or 1))),
+            thread_name_prefix="rag-ocr"
+        )
+        # 合併相同的進行中 LLM 請求
+        self.llm_single_flight = SingleFlight()
+        # 共用的非同步 HTTP 連線池，在第一次呼叫 API 時建立
+        self._http_client = None
+        # 背景上傳工作：上傳的檔案先串流寫入 spool_dir，保留最近 job_history_max 個工作的狀態
+        self.spool_dir = os.path.join(os.getenv('CACHE_DIR', 'cache'), 'uploads')
+        self.job_history_max = int(os.getenv('JOB_HISTORY_MAX', '100'))
+        # 上傳工作的狀態檔案，多個工作行程時由處理上傳以外的行程讀取
+        self.job_state_dir = os.path.join(os.getenv('CACHE_DIR', 'cache'), 'jobs')
+        os.makedirs(self.job_state_dir, exist_ok=True)
+        # 每隔多少秒檢查一次其他工作行程是否發布了新的索引世代
+        self.index_refresh_interval = float(os.getenv('INDEX_REFRESH_INTERVAL', '1'))
+        self.ingestion_jobs = OrderedDict()
+        self._job_tasks = set()
+    
+    @property
+    def embeddings(self):
+        """正規化後的嵌入向量矩陣"""
+        return self.vector_index.vectors
+    
+    @embeddings.setter
+    def embeddings(self, vectors):
+        self.vector_index = VectorIndex(vectors)
+    
+    def ensure_loaded(self):
+        """被移出記憶體的課程在下次使用時重新載入索引"""
+        with self._index_lock:
+            if not self.resident:
+                self.load_latest_index()
+    
+    def unload(self):
+        """將課程的索引移出記憶體，磁碟上的索引世代保持不變"""
+        with self._index_lock:
+            self.course_data = []
+            self.vector_index = VectorIndex()
+            self.lexical_index = LexicalIndex()
+            self.file_info = []
+            self.answer_cache.clear()
+            self.resident = False
+        print(f"課程 {self.course_id} 的索引已移出記憶體")
+    
+    def loaded_generation(self) -> Optional[int]:
+        """目前載入的索引世代編號"""
+        return int(os.path.basename(self.current_session)[4:]) if self.current_session else None
+    
+    def index_is_stale(self) -> bool:
+        """每 index_refresh_interval 秒讀取一次 CURRENT，其他工作行程發布或清除索引後返回 True"""
+        now = time.monotonic()
+        if not self.resident or now - self._index_checked_at < self.index_refresh_interval:
+            return False
+        self._index_checked_at = now
+        return read_current_generation(self.index_dir) != self.loaded_generation()
+    
+    def refresh_index(self):
+        """換入 CURRENT 指向的索引世代；索引已被清除時清空記憶體中的資料"""
+        with self._index_lock:
+            if read_current_generation(self.index_dir) == self.loaded_generation():
+                return
+            if not self.load_latest_index():
+                self._reset_index()
+    
+    def _reset_index(self):
+        with self._index_lock:
+            self.current_session = None
+            self.course_data = []
+            self.embeddings = []
+            self.file_info = []
+            self.lexical_index = LexicalIndex()
+            self.answer_cache.clear()
+    
+    def resident_bytes(self) -> int:
+        """估計索引載入後佔用的記憶體：目前索引世代中所有檔案的大小
+        
+        使用壓縮向量時 float32 向量只在重新計分時讀取少數列，不計入
+        """
+        if not self.resident or not self.current_session:
+            return 0
+        skipped = {'vectors.npy'} if self.vector_index.quantized is not None else set()
+        try:
+            return sum(entry.stat().st_size for entry in os.scandir(self.current_session)
+                       if entry.is_file() and entry.name not in skipped)
+        except OSError:
+            return 0
+    
+    def load_latest_index(self) -> bool:
+        """重新開啟上次存檔的索引，讓重啟後不需重新上傳與編碼"""
+        start_time = time.time()
+        self.resident = True
+        try:
+            index = load_index(self.index_dir, self.model_name)
+        except Exception as e:
+            print(f"載入索引時出錯: {str(e)}")
+            return False
+        if index is None:
+            return False
+        
+        self.answer_cache.clear()
+        self.course_data = index["course_data"]
+        self.vector_index = VectorIndex(index["embeddings"] if len(index["course_data"]) else None,
+                                        ivf=index["ivf"], quantized=index["quantized"])
+        self.file_info = index["file_info"]
+        # 舊的索引世代沒有詞彙索引時，從段落重新建立
+        self.lexical_index = index["lexical"] or LexicalIndex.build(self.course_data, self.file_info)
+        self.current_session = index["path"]
+        print(f"已載入索引 {os.path.basename(index['path'])}: {len(self.course_data)} 個段落，耗時 {(time.time() - start_time) * 1000:.1f} 毫秒")
+        return True
     
     def get_or_create_conversation(self, session_id: Optional[str] = None) -> Conversation:
         """獲取現有對話或創建新對話"""
-        if session_id and session_id in self.conversations:
-            return self.conversations[session_id]
+        if session_id:
+            conversation = self.conversations.get(session_id)
+            if conversation is not None:
+                return conversation
         
         # 創建新對話
         conversation = Conversation(session_id)
-        self.conversations[conversation.session_id] = conversation
+        self.conversations.add(conversation)
         return conversation
     
-    def split_text_into_chunks(self, text: str, chunk_size: int = 150) -> List[str]:
-        """將文本分割成指定大小的段落"""
-        words = text.split()
-        chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for word in words:
-            if current_length + len(word) + 1 <= chunk_size:
-                current_chunk.append(word)
-                current_length += len(word) + 1
+    async def run_blocking(self, fn, *args, **kwargs):
+        """在 CPU 執行緒池中執行阻塞的函數"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu_executor, functools.partial(fn, *args, **kwargs))
+    
+    async def run_ingest(self, fn, *args, **kwargs):
+        """在上傳工作的執行緒池中執行阻塞的函數"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.ingest_executor, functools.partial(fn, *args, **kwargs))
+    
+    def _get_http_client(self) -> httpx.AsyncClient:
+        root = self._root
+        if root._http_client is None:
+            root._http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            )
+        return root._http_client
+    
+    async def aclose(self):
+        """關閉所有課程共用的 HTTP 連線池與執行緒池並保存對話，只需對第一個 RAGSystem 呼叫"""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+        self.cpu_executor.shutdown(wait=False)
+        self.ingest_executor.shutdown(wait=False)
+        self.ocr_executor.shutdown(wait=False)
+        self.conversations.flush()
+        self.embedding_cache.flush()
+    
+    @property
+    def model(self):
+        """嵌入模型，尚未載入完成時等待"""
+        return self.model_loader.get()
+    
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        """第一次切分段落時才取得 tokenizer，避免建立 RAGSystem 時等待模型載入"""
+        if self._token_counter is None:
+            self._token_counter = self._tokenizer_counter() or (
+                lambda texts: [estimate_text_tokens(text) for text in texts]
+            )
+        return self._token_counter(texts)
+    
+    def _tokenizer_counter(self) -> Optional[Callable[[List[str]], List[int]]]:
+        """以嵌入模型的 tokenizer 計算 token 數；模型沒有 tokenizer 時返回 None，改用估計值
+        
+        編碼時模型會以截斷與補齊設定呼叫同一個 fast tokenizer，與不截斷的呼叫並行時會改動其設定而拋出
+        RuntimeError: Already borrowed，因此使用獨立的副本，並以鎖序列化多個上傳執行緒的呼叫
+        """
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        if tokenizer is None:
+            return None
+        tokenizer = copy.deepcopy(tokenizer)
+        lock = threading.Lock()
+        
+        def count(texts: List[str]) -> List[int]:
+            with lock:
+                return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)['input_ids']]
+        return count
+    
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """生成嵌入向量，已快取的段落不會重新編碼"""
+        return self.embedding_cache.encode(texts, self.embedding_batcher.encode)
+    
+    async def encode_texts_async(self, texts: List[str]) -> np.ndarray:
+        """查詢路徑使用的 encode_texts：在事件迴圈上等待批次編碼，不佔用 cpu_executor 的執行緒"""
+        result, missing = await self.run_blocking(self.embedding_cache.lookup, texts)
+        if missing:
+            miss_texts = [texts[idx[0]] for idx in missing.values()]
+            batcher = self.embedding_batcher
+            future = None
+            if len(miss_texts) < batcher.max_batch_size:
+                with contextlib.suppress(queue.Full):
+                    future = batcher.submit(miss_texts, block=False)
+            if future is not None:
+                vectors = await asyncio.wrap_future(future)
             else:
-                if current_chunk:
-                    chunks.append(' '.join(current_chunk))
-                current_chunk = [word]
-                current_length = len(word)
+                # 大量問題直接編碼；佇列已滿時在執行緒池中等待佇列空位
+                vectors = await self.run_blocking(batcher.encode, miss_texts)
+            await self.run_blocking(self.embedding_cache.store, missing, vectors, result)
+        return self.embedding_cache.stack(result)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """回傳系統各元件的統計數據"""
+        return {
+            "model": self.model_loader.stats(),
+            "embedding_cache": self.embedding_cache.stats(),
+            "ocr_cache": self.ocr_cache.stats(),
+            "vector_index": self.vector_index.stats(),
+            "embedding_batcher": self.embedding_batcher.stats(),
+            "rate_limiter": self.rate_limiter.stats(),
+            "answer_cache": self.answer_cache.stats(),
+            "llm_single_flight": self.llm_single_flight.stats(),
+            "conversations": self.conversations.stats()
+        }
+    
+    def split_text_into_chunks(self, text: str) -> List[str]:
+        """依句子與 token 長度將文本分割成段落"""
+        return list(self.chunker.iter_chunks(text))
+    
+    def _create_pdf_executor(self, pdf_content: bytes, workers: int) -> Tuple[Any, Callable[[int, int], List[Tuple[str, float]]]]:
+        """建立解析一份 PDF 的行程池，返回 (執行器, 解析 [start, end) 頁的函數)
+        
+        只在支援 fork 的平台使用行程池，避免工作行程重新匯入本模組並載入模型；PDF 內容在建立工作行程時
+        繼承，不會隨每個工作序列化傳送。其他平台退回執行緒池
+        """
+        # 在 fork 之前匯入，工作行程不需各自匯入
+        importlib.import_module('PyPDF2')
+        if 'fork' in multiprocessing.get_all_start_methods():
+            executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_pdf_worker, initargs=(pdf_content,)
+            )
+            return executor, _extract_worker_page_range
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-pdf")
+        return executor, functools.partial(extract_pdf_page_range, pdf_content)
+    
+    def extract_pdf_pages(self, pdf_content: bytes, page_count: int,
+                          progress: Optional[Callable[[str, int], None]] = None) -> List[Tuple[str, float]]:
+        """將頁面範圍分給行程池並行解析，依原始頁序合併結果
         
-        if current_chunk:
-            chunks.append(' '.join(current_chunk))
+        工作行程異常結束（例如記憶體不足被終止）時，重新建立行程池並重試尚未完成的頁面範圍一次
+        """
+        if page_count <= self.pdf_pages_per_task or self.pdf_workers <= 1:
+            results = extract_pdf_page_range(pdf_content, 0, page_count)
+            if progress is not None:
+                progress("pages_extracted", len(results))
+            return results
         
-        return chunks
+        pages_per_task = max(self.pdf_pages_per_task, -(-page_count // (self.pdf_workers * 4)))
+        ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+        range_results = {}
+        with self._pdf_pool_lock:
+            for attempt in range(2):
+                pending = [i for i in range(len(ranges)) if i not in range_results]
+                executor, extract_range = self._create_pdf_executor(pdf_content, min(self.pdf_workers, len(pending)))
+                try:
+                    with executor:
+                        futures = {i: executor.submit(extract_range, *ranges[i]) for i in pending}
+                        for i, future in futures.items():
+                            range_results[i] = future.result()
+                            if progress is not None:
+                                progress("pages_extracted", len(range_results[i]))
+                    break
+                except BrokenProcessPool:
+                    if attempt:
+                        raise
+                    print(f"PDF 解析的工作行程異常結束，重新建立行程池並重試 {len(ranges) - len(range_results)} 個頁面範圍")
+        return [page for i in range(len(ranges)) for page in range_results[i]]
     
-    def extract_text_from_pdf(self, pdf_content: bytes) -> str:
-        """從PDF文件中提取文字內容"""
+    def extract_text_from_pdf(self, pdf_content: bytes, stats: Optional[Dict[str, Any]] = None,
+                              progress: Optional[Callable[[str, int], None]] = None) -> str:
+        """從PDF文件中提取文字內容
+        
+        若提供 stats，會寫入頁數與每頁的提取耗時；progress(欄位, 增量) 會收到
+        pages_total、pages_extracted、ocr_pages_total 與 ocr_pages_done 的進度
+        """
+        import PyPDF2
         text = ""
         try:
-            # 嘗試直接從PDF提取文字
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                temp_file.write(pdf_content)
-                temp_file_path = temp_file.name
-
-            with open(temp_file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page_num in range(len(pdf_reader.pages)):
-                    page = pdf_reader.pages[page_num]
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n\n"
+            # 嘗試直接從記憶體中的PDF提取文字，不建立暫存檔
+            start_time = time.perf_counter()
+            page_count = len(PyPDF2.PdfReader(io.BytesIO(pdf_content)).pages)
+            if progress is not None:
+                progress("pages_total", page_count)
+            page_results = self.extract_pdf_pages(pdf_content, page_count, progress)
             
-            # 如果提取的文字內容太少，可能是掃描PDF，使用OCR
-            if len(text.strip()) < 100:
-                print("直接提取的文字內容太少，嘗試使用OCR...")
-                text = self.process_pdf_with_ocr(pdf_content)
-            
-            os.unlink(temp_file_path)
-            return text
+            page_seconds = [seconds for _, seconds in page_results]
+            elapsed = time.perf_counter() - start_time
+            print(f"PDF 共 {page_count} 頁，直接提取耗時 {elapsed:.2f} 秒"
+                  f"（單頁平均 {sum(page_seconds) / max(page_count, 1) * 1000:.1f} 毫秒，最慢 {max(page_seconds, default=0) * 1000:.1f} 毫秒）")
+            if stats is not None:
+                stats['pages'] = page_count
+                stats['extract_seconds'] = elapsed
+                stats['page_seconds'] = page_seconds
         except Exception as e:
             print(f"提取PDF文字時出錯: {str(e)}")
-            # 嘗試使用OCR
-            return self.process_pdf_with_ocr(pdf_content)
+            # 無法解析PDF結構時，對整份文件使用OCR
+            return self.process_pdf_with_ocr(pdf_content, progress)
+        
+        # 只對無法直接提取文字的頁面（通常是掃描頁）進行OCR
+        empty_pages = [page_num + 1 for page_num, (page_text, _) in enumerate(page_results) if not page_text.strip()]
+        ocr_texts = {}
+        if empty_pages:
+            print(f"{len(empty_pages)} 頁沒有可直接提取的文字，對這些頁面使用OCR...")
+            ocr_start = time.perf_counter()
+            try:
+                ocr_texts = self.ocr_pdf_pages(pdf_content, empty_pages, progress)
+            except Exception as e:
+                print(f"OCR處理失敗: {str(e)}")
+            if stats is not None:
+                stats['ocr_pages'] = len(empty_pages)
+                stats['ocr_seconds'] = time.perf_counter() - ocr_start
+        
+        for page_num, (page_text, _) in enumerate(page_results):
+            if page_text.strip():
+                text += page_text + "\n\n"
+            else:
+                text += ocr_texts.get(page_num + 1, "")
+        return text
+    
+    def _ocr_window_pages(self) -> int:
+        """依記憶體上限計算每個渲染視窗的頁數
+        
+        以 A4 RGB 頁面估算單頁圖像大小，並預留同樣大小給 tesseract 的工作記憶體
+        """
+        page_mb = (8.27 * self.ocr_dpi) * (11.69 * self.ocr_dpi) * 3 / (1024 * 1024)
+        return max(1, int(self.ocr_max_memory_mb // (page_mb * 2)))
+    
+    def _ocr_image(self, page_number: int, image, cache_key: Optional[str] = None) -> str:
+        """對單一頁面圖像進行OCR，返回該頁文字（含圖像描述），並寫入 OCR 快取"""
+        import pytesseract
+        print(f"處理第{page_number}頁...")
+        start_time = time.perf_counter()
+        # 使用pytesseract進行OCR (指定中文語言)
+        page_text = pytesseract.image_to_string(image, lang=self.ocr_lang)
+        page_text += "\n\n"
+        
+        # 添加圖像描述
+        image_description = self.get_image_description(image)
+        if image_description:
+            page_text += f"圖片描述: {image_description}\n\n"
+        if cache_key is not None:
+            self.ocr_cache.put(cache_key, page_text, time.perf_counter() - start_time)
+        return page_text
+    
+    def _ocr_cache_keys(self, pdf_content: bytes, page_numbers: List[int]) -> Dict[int, str]:
+        """計算各頁的 OCR 快取鍵；無法解析 PDF 結構時改用整份檔案的雜湊加上頁碼"""
+        try:
+            page_hashes = pdf_page_hashes(pdf_content, page_numbers)
+        except Exception:
+            document_hash = hashlib.sha256(pdf_content).hexdigest()
+            page_hashes = {page_number: f"{document_hash}#{page_number}" for page_number in page_numbers}
+        return {
+            page_number: OCRCache.make_key(page_hash, self.ocr_lang, self.ocr_dpi)
+            for page_number, page_hash in page_hashes.items()
+        }
+    
+    def ocr_pdf_pages(self, pdf_content: bytes, page_numbers: List[int],
+                      progress: Optional[Callable[[str, int], None]] = None) -> Dict[int, str]:
+        """以小視窗逐段渲染並OCR指定的頁面（頁碼從 1 開始），返回 {頁碼: 文字}
+        
+        已在 OCR 快取中的頁面直接使用快取結果，不會渲染；其餘頁面每次只用 first_page/last_page
+        渲染一個視窗，視窗內的頁面交給 OCR 執行緒池並行處理，完成後才渲染下一個視窗；
+        所有文件共用同一個視窗鎖，因此記憶體用量不會隨文件頁數或並行提取的文件數增加
+        """
+        from pdf2image import convert_from_bytes
+        page_numbers = sorted(set(page_numbers))
+        cache_keys = self._ocr_cache_keys(pdf_content, page_numbers)
+        cached = self.ocr_cache.get_many(list(cache_keys.values()))
+        results = {
+            page_number: cached[cache_keys[page_number]]
+            for page_number in page_numbers if cache_keys[page_number] in cached
+        }
+        if results:
+            print(f"{len(results)} 頁使用OCR快取結果")
+        if progress is not None:
+            progress("ocr_pages_total", len(page_numbers))
+            progress("ocr_pages_done", len(results))
+        
+        window = self._ocr_window_pages()
+        runs = []
+        for page_number in page_numbers:
+            if page_number in results:
+                continue
+            if runs and page_number == runs[-1][1] + 1 and runs[-1][1] - runs[-1][0] + 1 < window:
+                runs[-1][1] = page_number
+            else:
+                runs.append([page_number, page_number])
+        
+        for first_page, last_page in runs:
+            with self._ocr_window_lock:
+                images = convert_from_bytes(pdf_content, dpi=self.ocr_dpi, first_page=first_page, last_page=last_page)
+                futures = [
+                    self.ocr_executor.submit(self._ocr_image, page_number, image, cache_keys[page_number])
+                    for page_number, image in zip(range(first_page, last_page + 1), images)
+                ]
+                for page_number, future in zip(range(first_page, last_page + 1), futures):
+                    results[page_number] = future.result()
+                    if progress is not None:
+                        progress("ocr_pages_done", 1)
+                # 釋放這個視窗的圖像後再渲染下一批
+                del images, futures
+        return results
     
-    def process_pdf_with_ocr(self, pdf_content: bytes) -> str:
-        """使用OCR處理PDF掃描文件"""
+    def process_pdf_with_ocr(self, pdf_content: bytes, progress: Optional[Callable[[str, int], None]] = None) -> str:
+        """使用OCR處理整份PDF掃描文件"""
+        from pdf2image import pdfinfo_from_bytes
         print("開始OCR處理PDF...")
         all_text = ""
         try:
-            # 將PDF轉換為圖像
-            images = convert_from_bytes(pdf_content, dpi=300)
-            
-            # 對每個圖像進行OCR處理
-            for i, image in enumerate(images):
-                print(f"處理第{i+1}頁...")
-                # 使用pytesseract進行OCR (指定中文語言)
-                page_text = pytesseract.image_to_string(image, lang='chi_tra+eng')
-                all_text += page_text + "\n\n"
-                
-                # 添加圖像描述
-                image_description = self.get_image_description(image)
-                if image_description:
-                    all_text += f"圖片描述: {image_description}\n\n"
+            page_count = int(pdfinfo_from_bytes(pdf_content)["Pages"])
+            ocr_texts = self.ocr_pdf_pages(pdf_content, list(range(1, page_count + 1)), progress)
+            for page_number in range(1, page_count + 1):
+                all_text += ocr_texts.get(page_number, "")
             
             print(f"OCR處理完成，提取了{len(all_text)}個字符")
             return all_text
@@ -168,6 +2815,7 @@ class RAGSystem:
     
     def get_image_description(self, image) -> str:
         """使用 Groq API 為圖像生成描述"""
+        from PIL import Image
         # 轉換圖像為 base64 字符串
         try:
             # 如果圖像太大，調整大小
@@ -181,100 +2829,374 @@ class RAGSystem:
             print(f"生成圖像描述失敗: {str(e)}")
             return ""
     
-    def prepare_course_data(self, course_texts: List[str], file_types: List[str] = None) -> str:
-        """準備課程資料並生成嵌入向量"""
+    def compute_content_hash(self, content) -> str:
+        """計算內容的雜湊值，用於判斷文件或段落是否變更"""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+    
+    def _encode_document_chunks(self, corpus: StagedCorpus, chunks: List[str], previous: Optional[Dict] = None,
+                                progress: Optional[Callable[[str, int], None]] = None,
+                                vectors: Optional[np.ndarray] = None):
+        """為文件段落生成嵌入向量，若為更新則沿用未變更段落的向量
+        
+        vectors 為上傳工作已編碼好的段落向量時直接使用，返回的新編碼數仍以舊版本文件計算
+        """
+        if not chunks:
+            return [], 0
+        
+        reusable = {}
+        if previous is not None:
+            start_idx = previous["chunk_range"][0]
+            for offset in range(previous["chunk_count"]):
+                chunk = corpus.course_data[start_idx + offset]
+                reusable[self.compute_content_hash(chunk)] = corpus.vector_index.vectors[start_idx + offset]
+        
+        chunk_hashes = [self.compute_content_hash(chunk) for chunk in chunks]
+        missing = [i for i, chunk_hash in enumerate(chunk_hashes) if chunk_hash not in reusable]
+        if vectors is not None:
+            return np.asarray(vectors, dtype=np.float32), len(missing)
+        if progress is not None:
+            progress("chunks_embedded", len(chunks) - len(missing))
+        
+        # 分批編碼，讓背景工作可以回報編碼進度
+        new_embeddings = []
+        for start in range(0, len(missing), self.embed_progress_batch):
+            batch = missing[start:start + self.embed_progress_batch]
+            new_embeddings.extend(self.encode_texts([chunks[i] for i in batch]))
+            if progress is not None:
+                progress("chunks_embedded", len(batch))
+        vectors = []
+        missing_pos = {idx: pos for pos, idx in enumerate(missing)}
+        for i, chunk_hash in enumerate(chunk_hashes):
+            if i in missing_pos:
+                vectors.append(new_embeddings[missing_pos[i]])
+            else:
+                vectors.append(reusable[chunk_hash])
+        return np.stack(vectors), len(missing)
+    
+    def prepare_course_data(self, course_texts: List[str], file_types: List[str] = None,
+                            file_names: List[str] = None, mode: str = "replace",
+                            progress: Optional[Callable[[str, int], None]] = None,
+                            embedded: Optional[List[Optional[Tuple[List[str], np.ndarray]]]] = None) -> str:
+        """準備課程資料並生成嵌入向量
+        
+        mode 為 "replace" 時取代所有資料；為 "append" 或 "update" 時依檔名與內容雜湊
+        增量更新，只對新增或變更的段落生成嵌入向量。處理期間查詢仍使用舊的索引，
+        完成後才換入新的索引世代。progress(欄位, 增量) 會收到 chunks_total 與 chunks_embedded 的進度。
+        embedded 為各文件已分割與編碼的 (段落, 向量)，為 None 的文件在此分割與編碼
+        """
+        with self._ingest_lock, self._index_file_lock.acquire():
+            # 以其他工作行程最後發布的世代為基礎進行增量更新
+            self.refresh_index()
+            return self._prepare_course_data(course_texts, file_types, file_names, mode, progress, embedded)
+    
+    def _prepare_course_data(self, course_texts: List[str], file_types: List[str] = None,
+                             file_names: List[str] = None, mode: str = "replace",
+                             progress: Optional[Callable[[str, int], None]] = None,
+                             embedded: Optional[List[Optional[Tuple[List[str], np.ndarray]]]] = None) -> str:
         print("正在處理課程資料...")
-        all_chunks = []
-        file_info = []
+        if mode not in ("replace", "append", "update"):
+            raise ValueError(f"不支援的處理模式: {mode}")
+        
+        if mode == "replace":
+            corpus = StagedCorpus()
+        else:
+            with self._index_lock:
+                self.ensure_loaded()
+                corpus = StagedCorpus(self.course_data, self.vector_index, self.file_info, self.lexical_index)
+        
+        file_report_lines = []
+        encoded_count = 0
         
         for i, text in enumerate(course_texts):
             # 檢查文件類型，若為PDF則特殊處理
             file_type = file_types[i] if file_types and i < len(file_types) else "txt"
-            file_name = f"文件{i+1}.{file_type}"
+            file_name = file_names[i] if file_names and i < len(file_names) else f"文件{len(corpus.file_info)+1}.{file_type}"
+            content_hash = self.compute_content_hash(text)
             
             print(f"處理文件 {i+1}: {file_type} 類型")
             
+            position = corpus.find(file_name)
+            if position is not None and corpus.file_info[position]["content_hash"] == content_hash:
+                print(f"文件 {file_name} 內容未變更，略過")
+                file_report_lines.append(f"- {file_name}: 內容未變更")
+                continue
+            if position is None and any(info["content_hash"] == content_hash for info in corpus.file_info):
+                print(f"文件 {file_name} 與已存在的文件內容相同，略過")
+                file_report_lines.append(f"- {file_name}: 內容與已存在的文件相同")
+                continue
+            
             # 分割文本
-            chunks = self.split_text_into_chunks(text)
-            start_idx = len(all_chunks)
-            all_chunks.extend(chunks)
-            end_idx = len(all_chunks) - 1
+            document = embedded[i] if embedded and i < len(embedded) else None
+            chunks, vectors = document if document is not None else (self.split_text_into_chunks(text), None)
+            if progress is not None:
+                progress("chunks_total", len(chunks))
+            previous = corpus.file_info[position] if position is not None else None
+            embeddings, new_count = self._encode_document_chunks(corpus, chunks, previous, progress, vectors)
+            encoded_count += new_count
             
             # 記錄文件信息
-            file_info.append({
+            info = {
                 "file_name": file_name,
                 "file_type": file_type,
-                "chunk_range": (start_idx, end_idx),
+                "content_hash": content_hash,
+                "chunk_range": (0, -1),
                 "chunk_count": len(chunks)
-            })
+            }
+            corpus.splice(position if position is not None else len(corpus.file_info), chunks, embeddings, info)
             
-            print(f"文件 {i+1} 已處理: 生成了 {len(chunks)} 個段落")
-        
-        # 更新課程數據
-        self.course_data = all_chunks
-        print("正在生成嵌入向量...")
-        self.embeddings = self.model.encode(self.course_data)
+            action = "已更新" if previous is not None else "已加入"
+            file_report_lines.append(f"- {file_name}: {len(chunks)} 個段落（{action}，新編碼 {new_count} 個）")
+            print(f"文件 {i+1} 已處理: 生成了 {len(chunks)} 個段落，其中 {new_count} 個需要重新編碼")
         
-        # 新增唯一資料夾
-        session_id = str(uuid.uuid4())
-        session_path = os.path.join(self.data_dir, session_id)
-        os.makedirs(session_path, exist_ok=True)
-        self.current_session = session_path
-        
-        # 存檔
-        with open(os.path.join(session_path, 'course_data.json'), 'w', encoding='utf-8') as f:
-            json.dump({
-                'course_data': self.course_data,
-                'file_info': file_info
-            }, f, ensure_ascii=False, indent=2)
-        
-        with open(os.path.join(session_path, 'embeddings.pkl'), 'wb') as f:
-            pickle.dump(self.embeddings, f)
+        self._save_index(corpus)
         
         # 生成處理報告
-        file_report = "\n".join([f"- {info['file_name']}: {info['chunk_count']} 個段落" for info in file_info])
+        file_report = "\n".join(file_report_lines)
         report = f"成功處理 {len(course_texts)} 個文件，共 {len(self.course_data)} 個段落\n\n文件詳情:\n{file_report}"
         
-        print(f"已處理 {len(course_texts)} 個文件，共 {len(self.course_data)} 個段落")
+        print(f"已處理 {len(course_texts)} 個文件，新編碼 {encoded_count} 個段落，共 {len(self.course_data)} 個段落")
         return report
     
+    def remove_documents(self, file_names: List[str]) -> str:
+        """從課程資料中移除指定的文件，不需重新生成其他文件的嵌入向量"""
+        removed = []
+        with self._ingest_lock, self._index_file_lock.acquire():
+            with self._index_lock:
+                self.ensure_loaded()
+                self.refresh_index()
+                corpus = StagedCorpus(self.course_data, self.vector_index, self.file_info, self.lexical_index)
+            for file_name in file_names:
+                position = corpus.find(file_name)
+                if position is None:
+                    continue
+                corpus.splice(position, [], [], None)
+                removed.append(file_name)
+            
+            if removed:
+                self._save_index(corpus)
+        return f"已移除 {len(removed)} 個文件，剩餘 {len(self.course_data)} 個段落"
+    
+    def _save_index(self, corpus: StagedCorpus):
+        """將處理完成的課程資料寫成新的索引世代，再整份換入記憶體映射的版本"""
+        write_index(self.index_dir, corpus.course_data, corpus.vector_index, corpus.file_info, self.model_name, corpus.lexical_index)
+        with self._index_lock:
+            self.load_latest_index()
+    
+    def create_ingestion_job(self, file_names: List[str], mode: str) -> IngestionJob:
+        """建立背景上傳工作，超過保留數量時移除最舊的已完成工作"""
+        job = IngestionJob(file_names, mode, self.course_id, state_dir=self.job_state_dir)
+        self.ingestion_jobs[job.job_id] = job
+        for job_id in list(self.ingestion_jobs):
+            if len(self.ingestion_jobs) <= self.job_history_max:
+                break
+            if self.ingestion_jobs[job_id].finished:
+                old_job = self.ingestion_jobs.pop(job_id)
+                with contextlib.suppress(OSError):
+                    os.remove(old_job.state_path)
+        return job
+    
+    def get_job_state(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """取得上傳工作的狀態；工作不在本行程時讀取其他工作行程寫入的狀態檔案"""
+        job = self.ingestion_jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        try:
+            uuid.UUID(job_id)
+            with open(os.path.join(self.job_state_dir, f"{job_id}.json"), encoding='utf-8') as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            return None
+    
+    def start_ingestion_job(self, job: IngestionJob, job_dir: str, paths: List[str]):
+        """在背景執行上傳工作，HTTP 請求不需等待處理完成"""
+        task = asyncio.create_task(self.run_ingestion_job(job, job_dir, paths))
+        # 保留 task 的參照，避免執行中被垃圾回收
+        self._job_tasks.add(task)
+        task.add_done_callback(self._job_tasks.discard)
+    
+    def extract_uploaded_file(self, path: str, file_name: str,
+                              progress: Optional[Callable[[str, int], None]] = None) -> Tuple[str, str, Optional[Dict]]:
+        """從暫存在磁碟上的上傳檔案提取文字，返回 (文字, 檔案類型, PDF 提取統計)"""
+        file_extension = os.path.splitext(file_name)[1].lower()
+        file_type = file_extension[1:] if file_extension else "txt"
+        with open(path, 'rb') as f:
+            content = f.read()
+        
+        if file_extension == '.pdf':
+            # 處理PDF文件
+            print(f"處理PDF文件: {file_name}")
+            pdf_stats = {}
+            extracted_text = self.extract_text_from_pdf(content, stats=pdf_stats, progress=progress)
+            if not extracted_text:
+                raise ValueError(f"無法從PDF文件中提取文字: {file_name}")
+            extraction = {
+                "file_name": file_name,
+                "pages": pdf_stats.get('pages', 0),
+                "extract_seconds": round(pdf_stats.get('extract_seconds', 0.0), 3),
+                "page_ms": [round(seconds * 1000, 1) for seconds in pdf_stats.get('page_seconds', [])]
+            }
+            return extracted_text, file_type, extraction
+        
+        # 處理文本文件
+        try:
+            return content.decode('utf-8'), file_type, None
+        except UnicodeDecodeError:
+            raise ValueError(f"無法解碼文件內容，請確保上傳的是文本文件或PDF: {file_name}")
+    
+    def embed_document(self, text: str, progress: Optional[Callable[[str, int], None]] = None) -> Tuple[List[str], np.ndarray]:
+        """分割文件並編碼所有段落，返回 (段落, 向量)，交給 prepare_course_data 直接使用"""
+        chunks = self.split_text_into_chunks(text)
+        if progress is not None:
+            progress("chunks_total", len(chunks))
+        vectors = []
+        for start in range(0, len(chunks), self.embed_progress_batch):
+            batch = chunks[start:start + self.embed_progress_batch]
+            vectors.extend(self.encode_texts(batch))
+            if progress is not None:
+                progress("chunks_embedded", len(batch))
+        return chunks, np.asarray(vectors, dtype=np.float32)
+    
+    def _is_unchanged_document(self, file_name: str, content_hash: str, file_info: List[Dict], mode: str) -> bool:
+        """prepare_course_data 是否會略過這份文件：同名文件內容未變更，或新檔名的內容與已存在的文件相同"""
+        if mode == "replace":
+            return False
+        names = {info["file_name"]: info["content_hash"] for info in file_info}
+        if file_name in names:
+            return names[file_name] == content_hash
+        return any(info["content_hash"] == content_hash for info in file_info)
+    
+    async def run_ingestion_job(self, job: IngestionJob, job_dir: str, paths: List[str]):
+        """並行提取上傳的文件，已提取的文件立即分割與編碼，全部完成後依原始順序換入新的索引
+        
+        內容未變更而會被 prepare_course_data 略過的文件不分割也不編碼
+        """
+        semaphore = asyncio.Semaphore(max(1, self.ingest_concurrency))
+        aborted = asyncio.Event()
+        file_info = self.file_info
+        
+        async def extract(file_name: str, path: str):
+            async with semaphore:
+                # 其他文件已失敗時不再開始讀取暫存檔
+                if aborted.is_set():
+                    return None
+                text, file_type, extraction = await self.run_ingest(self.extract_uploaded_file, path, file_name, job.advance)
+                job.advance("files_extracted")
+                if self._is_unchanged_document(file_name, self.compute_content_hash(text), file_info, job.mode):
+                    return text, file_type, extraction, None
+                # 與其他文件的提取重疊進行編碼
+                embedded = await self.run_ingest(self.embed_document, text, job.advance)
+            return text, file_type, extraction, embedded
+        
+        try:
+            job.set_status("extracting")
+            tasks = [asyncio.create_task(extract(file_name, path)) for file_name, path in zip(job.file_names, paths)]
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # 等待仍在執行緒中讀取 job_dir 的提取完成後才清除暫存檔
+                aborted.set()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            course_texts = [text for text, _, _, _ in results]
+            file_types = [file_type for _, file_type, _, _ in results]
+            job.extraction.extend(extraction for _, _, extraction, _ in results if extraction is not None)
+            
+            job.set_status("indexing")
+            # 段落已在提取階段分割與編碼，這裡依原始文件順序組合索引
+            message = await self.run_ingest(
+                self.prepare_course_data, course_texts, file_types, job.file_names, mode=job.mode,
+                embedded=[embedded for _, _, _, embedded in results]
+            )
+            job.set_status("completed", message=message)
+        except Exception as e:
+            print(f"上傳工作 {job.job_id} 失敗: {str(e)}")
+            job.set_status("failed", error=str(e))
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+    
     def clear_all_data(self):
-        shutil.rmtree(self.data_dir)
-        os.makedirs(self.data_dir, exist_ok=True)
-        self.current_session = None
-        self.course_data = []
-        self.embeddings = []
+        if not os.path.isdir(self.index_dir):
+            # 課程從未寫入索引，不需建立索引鎖檔案
+            self._reset_index()
+            return "已清除所有資料"
+        with self._ingest_lock, self._index_file_lock.acquire(), self._index_lock:
+            # 只刪除本課程的索引，預設課程的 data_dir 之下還有其他課程的資料
+            shutil.rmtree(self.index_dir, ignore_errors=True)
+            self._reset_index()
         return "已清除所有資料"
     
     def retrieve_relevant_chunks(self, query: str, k: int = 3) -> List[Tuple[str, float]]:
         """檢索相關段落"""
+        return self.retrieve_with_ids([query], k=k)[0][2]
+    
+    async def retrieve_with_ids_async(self, queries: List[str], k: int = 3) -> List[Tuple[np.ndarray, Tuple[int, ...], List[Tuple[str, float]]]]:
+        """非同步的 retrieve_with_ids：查詢編碼在事件迴圈上等待批次結果，只有檢索本身在執行緒池中進行"""
+        if not self.resident:
+            await self.run_blocking(self.ensure_loaded)
         if not self.course_data:
-            return []
+            return [(None, (), []) for _ in queries]
+        query_embeddings = await self.encode_texts_async(queries)
+        return await self.run_blocking(self.retrieve_with_ids, queries, k, query_embeddings)
+    
+    def retrieve_with_ids(self, queries: List[str], k: int = 3,
+                          query_embeddings: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, Tuple[int, ...], List[Tuple[str, float]]]]:
+        """以一次編碼與一次矩陣乘法檢索多個問題，返回 (查詢向量, 段落索引, [(段落, 相似度)])
         
-        # 對查詢進行編碼
-        query_embedding = self.model.encode([query])
+        混合檢索時另以 BM25 找出含有相同詞彙的段落，與向量檢索的排名以 RRF 融合；
+        融合後的段落同樣需通過向量檢索的相似度閾值。已提供 query_embeddings 時不再編碼
+        """
+        min_score = 0.1
+        self.ensure_loaded()
+        if self.index_is_stale():
+            self.refresh_index()
+        if not self.course_data:
+            return [(None, (), []) for _ in queries]
         
-        # 計算餘弦相似度
-        similarities = cosine_similarity(query_embedding, self.embeddings)[0]
+        # 對查詢進行編碼
+        if query_embeddings is None:
+            query_embeddings = self.encode_texts(queries)
         
-        # 獲取前 k 個最相似的段落
-        top_indices = np.argsort(similarities)[::-1][:k]
+        # 寫入與移出課程時整份換入新的物件，只在鎖內取得參照，檢索在鎖外進行，同一課程的查詢可以並行
+        with self._index_lock:
+            self.ensure_loaded()
+            course_data, vector_index, lexical_index = self.course_data, self.vector_index, self.lexical_index
+        if not course_data:
+            return [(None, (), []) for _ in queries]
         
-        relevant_chunks = []
-        for idx in top_indices:
-            if similarities[idx] > 0.1:  # 設定最低相似度閾值
-                relevant_chunks.append((self.course_data[idx], similarities[idx]))
+        # 以正規化向量的內積計算餘弦相似度，並過濾低於閾值的段落
+        if self.retrieval_mode != 'hybrid' or not lexical_index.total_docs:
+            results = vector_index.search_batch(query_embeddings, k=k, threshold=min_score)
+            return [
+                (query_embedding, tuple(int(idx) for idx in top_indices),
+                 [(course_data[idx], float(score)) for idx, score in zip(top_indices, scores)])
+                for query_embedding, (top_indices, scores) in zip(query_embeddings, results)
+            ]
         
-        return relevant_chunks
+        candidates = max(k, self.hybrid_candidates)
+        dense_results = vector_index.search_batch(query_embeddings, k=candidates, threshold=min_score)
+        retrieved = []
+        for query, query_embedding, (dense_ids, _) in zip(queries, query_embeddings, dense_results):
+            lexical_ids, _ = lexical_index.search(
+                query, candidates, deadline=time.perf_counter() + self.hybrid_latency_budget
+            )
+            fused = {}
+            for ranking in (dense_ids, lexical_ids):
+                for rank, idx in enumerate(ranking):
+                    fused[int(idx)] = fused.get(int(idx), 0.0) + 1.0 / (self.hybrid_rrf_k + rank + 1)
+            ranked = sorted(fused, key=fused.get, reverse=True)
+            # 回傳的分數仍為餘弦相似度，讓來源顯示與回答快取的語意不變；
+            # CJK 雙字詞幾乎總有命中，只由 BM25 找到且與問題語意無關的段落在此濾除
+            # 以 pread 讀取候選段落的 float32 向量，隨機存取映射區域會讓整個向量檔案進入常駐記憶體
+            scores = vector_index._read_rows(np.asarray(ranked)) @ VectorIndex.normalize(query_embedding) if ranked else []
+            top = [(idx, float(score)) for idx, score in zip(ranked, scores) if score > min_score][:k]
+            retrieved.append((query_embedding, tuple(idx for idx, _ in top),
+                              [(course_data[idx], score) for idx, score in top]))
+        return retrieved
     
-    def call_groq_api(self, messages, max_retries=3, initial_wait=30):
-        """處理 Groq API 呼叫，包含重試機制"""
-        current_time = time.time()
-        # 確保與上次 API 呼叫間隔至少 1 秒
-        time_since_last_call = current_time - self.last_api_call
-        if time_since_last_call < 1:
-            time.sleep(1 - time_since_last_call)
-
+    def _groq_request(self, messages, stream: bool = False) -> Tuple[Dict[str, str], Dict[str, Any]]:
+        """組合 Groq API 的請求標頭與內容"""
         headers = {
             'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json'
@@ -286,38 +3208,125 @@ class RAGSystem:
             "temperature": 0.7,
             "max_tokens": 3000
         }
-
+        if stream:
+            data["stream"] = True
+        return headers, data
+    
+    async def call_groq_api(self, messages, max_retries=3, stats: Optional[Dict[str, Any]] = None):
+        """處理 Groq API 呼叫，包含速率限制與重試機制
+        
+        相同模型、訊息與取樣參數的並行呼叫只會送出一次上游請求並共用結果。
+        若提供 stats，會寫入本次呼叫等待速率限制器的秒數 (limiter_wait)
+        """
+        headers, data = self._groq_request(messages)
+        key = hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+        result, limiter_wait = await self.llm_single_flight.do(
+            key, lambda: self._post_groq_request(headers, data, estimate_tokens(messages), max_retries)
+        )
+        if stats is not None:
+            stats['limiter_wait'] = limiter_wait
+        return result
+    
+    async def _post_groq_request(self, headers, data, estimated_tokens: int, max_retries: int) -> Tuple[Optional[Dict], float]:
+        """送出 Groq API 請求並處理重試，返回 (回應內容, 等待速率限制器的秒數)"""
+        client = self._get_http_client()
+        limiter_wait = 0.0
         for attempt in range(max_retries):
+            limiter_wait += await self.rate_limiter.acquire(estimated_tokens)
             try:
-                response = requests.post(
+                response = await client.post(
                     'https://api.groq.com/openai/v1/chat/completions',
                     headers=headers,
-                    json=data,
-                    timeout=30
+                    json=data
                 )
-                self.last_api_call = time.time()
-
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 429:  # Rate limit error
-                    wait_time = initial_wait * (attempt + 1)  # 逐次增加等待時間
-                    print(f"遇到速率限制，等待 {wait_time} 秒後重試...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"API 錯誤：{response.status_code} - {response.text}")
-                    return None
-
             except Exception as e:
                 print(f"API 呼叫出錯：{str(e)}")
                 if attempt < max_retries - 1:
-                    time.sleep(initial_wait)
+                    delay = self.rate_limiter.backoff_delay(attempt)
+                    limiter_wait += delay
+                    await asyncio.sleep(delay)
                     continue
-                return None
+                return None, limiter_wait
+            
+            self.rate_limiter.update_from_headers(response.headers)
+            if response.status_code == 200:
+                result = response.json()
+                self.rate_limiter.reconcile(estimated_tokens, result.get('usage', {}).get('total_tokens'))
+                return result, limiter_wait
+            elif response.status_code == 429:  # Rate limit error
+                wait_time = self.rate_limiter.register_throttle(response.headers, attempt)
+                print(f"遇到速率限制，{wait_time:.1f} 秒後重試...")
+                continue
+            else:
+                print(f"API 錯誤：{response.status_code} - {response.text}")
+                return None, limiter_wait
 
-        return None
+        return None, limiter_wait
+    
+    async def stream_groq_api(self, messages, max_retries=3, stats: Optional[Dict[str, Any]] = None):
+        """以 stream 模式呼叫 Groq API，逐一產生回答的文字片段
+        
+        只有在尚未收到任何片段前才會重試；stats 的用法與 call_groq_api 相同，
+        串流完整結束時另外設定 stats['completed']
+        """
+        headers, data = self._groq_request(messages, stream=True)
+        client = self._get_http_client()
+        estimated_tokens = estimate_tokens(messages)
+        limiter_wait = 0.0
+        received = False
+        try:
+            for attempt in range(max_retries):
+                limiter_wait += await self.rate_limiter.acquire(estimated_tokens)
+                if stats is not None:
+                    stats['limiter_wait'] = limiter_wait
+                try:
+                    async with client.stream(
+                        'POST',
+                        'https://api.groq.com/openai/v1/chat/completions',
+                        headers=headers,
+                        json=data
+                    ) as response:
+                        self.rate_limiter.update_from_headers(response.headers)
+                        if response.status_code == 429:
+                            wait_time = self.rate_limiter.register_throttle(response.headers, attempt)
+                            print(f"遇到速率限制，{wait_time:.1f} 秒後重試...")
+                            continue
+                        if response.status_code != 200:
+                            body = await response.aread()
+                            print(f"API 錯誤：{response.status_code} - {body.decode('utf-8', 'replace')}")
+                            return
+                        
+                        async for line in response.aiter_lines():
+                            if not line.startswith('data:'):
+                                continue
+                            payload = line[len('data:'):].strip()
+                            if payload == '[DONE]':
+                                break
+                            chunk = json.loads(payload)
+                            usage = chunk.get('x_groq', {}).get('usage') or chunk.get('usage')
+                            if usage:
+                                self.rate_limiter.reconcile(estimated_tokens, usage.get('total_tokens'))
+                            choices = chunk.get('choices') or []
+                            delta = choices[0].get('delta', {}).get('content') if choices else None
+                            if delta:
+                                received = True
+                                yield delta
+                        if stats is not None:
+                            stats['completed'] = True
+                        return
+                except httpx.HTTPError as e:
+                    print(f"API 呼叫出錯：{str(e)}")
+                    if not received and attempt < max_retries - 1:
+                        delay = self.rate_limiter.backoff_delay(attempt)
+                        limiter_wait += delay
+                        await asyncio.sleep(delay)
+                        continue
+                    return
+        finally:
+            if stats is not None:
+                stats['limiter_wait'] = limiter_wait
 
-    def generate_questions(self, num_questions=5):
+    async def generate_questions(self, num_questions=5):
         """生成題目的主要函數"""
         print("開始生成題目...")
         
@@ -374,7 +3383,7 @@ D. [選項D內容]
 {context}"""
 
         print("呼叫 API 生成題目...")
-        result = self.call_groq_api([{"role": "user", "content": prompt}])
+        result = await self.call_groq_api([{"role": "user", "content": prompt}])
         if result:
             print("成功獲取 API 回應")
             full_content = result['choices'][0]['message']['content'].strip()
@@ -757,82 +3766,312 @@ D. [選項D內容]
         
         return text
 
-    def answer_query(self, question: str, session_id: Optional[str] = None) -> ConversationResponse:
-        """回答用戶問題，實現 RAG 功能"""
-        # 檢查課程資料是否存在
-        if not self.course_data:
-            return ConversationResponse(
-                answer="請先上傳課程文件以便我能回答相關問題。",
-                sources="",
-                history=[],
-                session_id=session_id or str(uuid.uuid4())
-            )
-        
-        # 獲取或創建對話
-        conversation = self.get_or_create_conversation(session_id)
+    def _build_rag_messages(self, question: str, relevant_chunks: List[Tuple[str, float]]) -> List[Dict[str, str]]:
+        """以檢索到的段落構建 LLM 的消息列表"""
+        # 構建提示詞
+        context = "\n\n".join([chunk for chunk, _ in relevant_chunks])
         
+        return [
+            {"role": "system", "content": "你是一個專業的中文教育助手，負責回答關於課程內容的問題。請基於提供的課程內容回答，如果問題沒有相關內容，請誠實地說明。使用繁體中文回覆，給出簡潔明了的答案。"},
+            {"role": "user", "content": f"基於以下課程內容回答我的問題：\n\n{context}\n\n問題：{question}"}
+        ]
+    
+    def _format_sources(self, relevant_chunks: List[Tuple[str, float]]) -> str:
+        """準備來源引用文字"""
+        return "\n\n".join([
+            f"來源 {i+1} (相關度: {score:.2f}):\n{chunk[:150]}..."
+            for i, (chunk, score) in enumerate(relevant_chunks)
+        ])
+    
+    async def _answer_with_chunks(self, question: str, retrieval, conversation: Conversation) -> ConversationResponse:
+        """根據 retrieve_with_ids 的檢索結果呼叫 LLM 回答問題，並更新對話歷史"""
+        query_vector, chunk_ids, relevant_chunks = retrieval
         # 添加用戶問題到對話歷史
         conversation.add_message("user", question)
+        api_stats = {}
         
         try:
-            # 檢索與問題相關的段落
-            relevant_chunks = self.retrieve_relevant_chunks(question, k=3)
-            
             if not relevant_chunks:
                 answer = "很抱歉，我在課程內容中找不到與您問題相關的信息。請嘗試使用不同的問題或上傳更多相關資料。"
                 sources = ""
             else:
-                # 構建提示詞
-                context = "\n\n".join([chunk for chunk, _ in relevant_chunks])
-                
-                # 構建消息列表
-                messages = [
-                    {"role": "system", "content": "你是一個專業的中文教育助手，負責回答關於課程內容的問題。請基於提供的課程內容回答，如果問題沒有相關內容，請誠實地說明。使用繁體中文回覆，給出簡潔明了的答案。"},
-                    {"role": "user", "content": f"基於以下課程內容回答我的問題：\n\n{context}\n\n問題：{question}"}
-                ]
-                
-                # 呼叫 LLM API
-                response = self.call_groq_api(messages)
-                
-                if response and 'choices' in response:
-                    answer = response['choices'][0]['message']['content']
-                    # 準備來源引用
-                    sources = "\n\n".join([
-                        f"來源 {i+1} (相關度: {score:.2f}):\n{chunk[:150]}..."
-                        for i, (chunk, score) in enumerate(relevant_chunks)
-                    ])
+                cached = self.answer_cache.lookup(query_vector, chunk_ids)
+                if cached is not None:
+                    answer, sources = cached["answer"], cached["sources"]
                 else:
-                    answer = "很抱歉，我在生成回答時遇到了問題。請稍後再試。"
-                    sources = ""
+                    messages = self._build_rag_messages(question, relevant_chunks)
+                    
+                    # 呼叫 LLM API
+                    start_time = time.time()
+                    response = await self.call_groq_api(messages, stats=api_stats)
+                    
+                    if response and 'choices' in response:
+                        answer = response['choices'][0]['message']['content']
+                        # 準備來源引用
+                        sources = self._format_sources(relevant_chunks)
+                        self.answer_cache.store(query_vector, chunk_ids, answer, sources, time.time() - start_time)
+                    else:
+                        answer = "很抱歉，我在生成回答時遇到了問題。請稍後再試。"
+                        sources = ""
             
             # 添加助手回答到對話歷史
             conversation.add_message("assistant", answer)
+            self.conversations.touch(conversation)
             
             # 返回結果
             return ConversationResponse(
                 answer=answer,
                 sources=sources,
                 history=conversation.get_history(),
-                session_id=conversation.session_id
+                session_id=conversation.session_id,
+                limiter_wait_ms=api_stats.get('limiter_wait', 0.0) * 1000
             )
             
         except Exception as e:
-            error_message = f"處理您的問題時發生錯誤: {str(e)}"
-            print(error_message)
-            traceback.print_exc()
-            
-            # 添加錯誤訊息到對話歷史
-            conversation.add_message("assistant", error_message)
-            
+            return self._error_response(conversation, e)
+    
+    def _error_response(self, conversation: Conversation, error: Exception) -> ConversationResponse:
+        """記錄錯誤並以錯誤訊息作為回答"""
+        error_message = f"處理您的問題時發生錯誤: {str(error)}"
+        print(error_message)
+        traceback.print_exc()
+        
+        # 添加錯誤訊息到對話歷史
+        conversation.add_message("assistant", error_message)
+        self.conversations.touch(conversation)
+        
+        return ConversationResponse(
+            answer=error_message,
+            sources="",
+            history=conversation.get_history(),
+            session_id=conversation.session_id
+        )
+    
+    async def answer_query(self, question: str, session_id: Optional[str] = None) -> ConversationResponse:
+        """回答用戶問題，實現 RAG 功能"""
+        # 檢查課程資料是否存在
+        if not self.course_data:
             return ConversationResponse(
-                answer=error_message,
+                answer="請先上傳課程文件以便我能回答相關問題。",
                 sources="",
-                history=conversation.get_history(),
-                session_id=conversation.session_id
+                history=[],
+                session_id=session_id or str(uuid.uuid4())
             )
+        
+        # 獲取或創建對話
+        conversation = self.get_or_create_conversation(session_id)
+        
+        try:
+            # 檢索與問題相關的段落
+            retrieval = (await self.retrieve_with_ids_async([question], k=3))[0]
+        except Exception as e:
+            conversation.add_message("user", question)
+            return self._error_response(conversation, e)
+        
+        return await self._answer_with_chunks(question, retrieval, conversation)
+    
+    async def stream_answer_query(self, question: str, session_id: Optional[str] = None):
+        """以 Server-Sent Events 串流回答：先送出來源，再逐段轉送 LLM 的回答，結束時更新對話歷史"""
+        if not self.course_data:
+            # 兩個事件必須帶相同的 session_id
+            session_id = session_id or str(uuid.uuid4())
+            yield format_sse("sources", {"sources": "", "session_id": session_id})
+            yield format_sse("done", {"answer": "請先上傳課程文件以便我能回答相關問題。", "history": [],
+                                      "session_id": session_id, "limiter_wait_ms": 0.0})
+            return
+        
+        conversation = self.get_or_create_conversation(session_id)
+        conversation.add_message("user", question)
+        api_stats = {}
+        answer_parts = []
+        
+        try:
+            query_vector, chunk_ids, relevant_chunks = (await self.retrieve_with_ids_async([question], k=3))[0]
+            cached = self.answer_cache.lookup(query_vector, chunk_ids) if relevant_chunks else None
+            if not relevant_chunks:
+                answer_parts.append("很抱歉，我在課程內容中找不到與您問題相關的信息。請嘗試使用不同的問題或上傳更多相關資料。")
+                yield format_sse("sources", {"sources": "", "session_id": conversation.session_id})
+                yield format_sse("token", {"text": answer_parts[0]})
+            elif cached is not None:
+                answer_parts.append(cached["answer"])
+                yield format_sse("sources", {"sources": cached["sources"], "session_id": conversation.session_id})
+                yield format_sse("token", {"text": cached["answer"]})
+            else:
+                sources = self._format_sources(relevant_chunks)
+                yield format_sse("sources", {"sources": sources, "session_id": conversation.session_id})
+                messages = self._build_rag_messages(question, relevant_chunks)
+                start_time = time.time()
+                async for delta in self.stream_groq_api(messages, stats=api_stats):
+                    answer_parts.append(delta)
+                    yield format_sse("token", {"text": delta})
+                if not answer_parts:
+                    answer_parts.append("很抱歉，我在生成回答時遇到了問題。請稍後再試。")
+                    yield format_sse("token", {"text": answer_parts[0]})
+                elif api_stats.get('completed'):
+                    self.answer_cache.store(query_vector, chunk_ids, "".join(answer_parts), sources, time.time() - start_time)
+            answer = "".join(answer_parts)
+        except Exception as e:
+            answer = f"處理您的問題時發生錯誤: {str(e)}"
+            print(answer)
+            traceback.print_exc()
+            yield format_sse("token", {"text": answer})
+        
+        # 串流結束後才將完整回答加入對話歷史
+        conversation.add_message("assistant", answer)
+        self.conversations.touch(conversation)
+        yield format_sse("done", {
+            "answer": answer,
+            "history": conversation.get_history(),
+            "session_id": conversation.session_id,
+            "limiter_wait_ms": api_stats.get('limiter_wait', 0.0) * 1000
+        })
+    
+    async def answer_queries(self, questions: List[str]) -> List[ConversationResponse]:
+        """批次回答多個問題：一次編碼與檢索所有問題，再並行呼叫 LLM，每個問題使用獨立的對話"""
+        if not self.course_data:
+            return [
+                ConversationResponse(
+                    answer="請先上傳課程文件以便我能回答相關問題。",
+                    sources="",
+                    history=[],
+                    session_id=str(uuid.uuid4())
+                )
+                for _ in questions
+            ]
+        
+        retrievals = await self.retrieve_with_ids_async(questions, k=3)
+        semaphore = asyncio.Semaphore(max(1, self.batch_query_concurrency))
+        
+        async def answer_one(question, retrieval):
+            async with semaphore:
+                return await self._answer_with_chunks(question, retrieval, self.get_or_create_conversation())
+        
+        return list(await asyncio.gather(*[
+            answer_one(question, retrieval) for question, retrieval in zip(questions, retrievals)
+        ]))
+
+class CorpusRegistry:
+    """依 course_id 管理各課程的 RAGSystem
+    
+    所有課程共用第一個 RAGSystem 的編碼模型與服務元件；最近使用的課程保留在記憶體中，
+    載入的索引總大小超過 memory_budget_mb 時，將最久未使用的課程移出，下次使用時再從磁碟索引載入。
+    只讀取的請求指定沒有索引的課程時使用不登記的暫時 RAGSystem，不會建立目錄，也不會佔用登記表
+    """
+    def __init__(self, root: RAGSystem, memory_budget_mb: float = 1024):
+        self.root = root
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.systems = OrderedDict({root.course_id: root})
+        # 每個課程上次檢查預算時的索引世代，世代改變或重新載入時才需要重新計算記憶體用量
+        self._checked_generations = {}
+        self.evictions = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def validate_course_id(course_id: str) -> str:
+        if not COURSE_ID_PATTERN.match(course_id or ""):
+            raise ValueError("course_id 只能包含英文字母、數字、底線與連字號，長度 1 到 64")
+        return course_id
+    
+    def get_resident(self, course_id: str) -> Optional[RAGSystem]:
+        """取得索引已在記憶體中的課程，不載入索引也不等待其他課程的載入，可在事件迴圈上呼叫"""
+        with self._lock:
+            system = self.systems.get(course_id)
+            if system is None or not system.resident:
+                return None
+            self.systems.move_to_end(course_id)
+            return system
+    
+    def get(self, course_id: str, create: bool = True) -> RAGSystem:
+        """取得課程的 RAGSystem，必要時建立或重新載入索引，並依記憶體預算移出其他課程
+        
+        create 為 False 時，磁碟上沒有索引的課程返回不登記的空 RAGSystem
+        """
+        self.validate_course_id(course_id)
+        with self._lock:
+            system = self.systems.get(course_id)
+            if system is not None:
+                self.systems.move_to_end(course_id)
+        if system is None:
+            # 在登記表的鎖外建立並載入索引，一個課程的載入不會阻塞其他課程的請求
+            system = RAGSystem(self.root.model_name, course_id=course_id, shared=self.root)
+            if not create and not os.path.isdir(system.index_dir):
+                return system
+            with self._lock:
+                # 其他執行緒可能已同時建立同一課程，沿用先登記的
+                system = self.systems.setdefault(course_id, system)
+                self.systems.move_to_end(course_id)
+        system.ensure_loaded()
+        self.check_budget(course_id)
+        return system
+    
+    def needs_budget_check(self, course_id: str) -> bool:
+        """課程的索引世代在上次檢查記憶體預算後是否改變"""
+        system = self.systems.get(course_id)
+        return system is not None and self._checked_generations.get(course_id) != system.current_session
+    
+    def check_budget(self, course_id: str):
+        """課程的索引世代改變或重新載入後，依記憶體預算移出其他課程"""
+        if self.needs_budget_check(course_id):
+            self._enforce_budget(keep=course_id)
+    
+    def _enforce_budget(self, keep: str):
+        # 計算大小與移出索引都在鎖外進行，鎖內只更新登記表
+        with self._lock:
+            systems = list(self.systems.items())
+        sizes = {course_id: system.resident_bytes() for course_id, system in systems}
+        total = sum(sizes.values())
+        evicted = []
+        with self._lock:
+            for course_id, system in systems:
+                if total <= self.memory_budget:
+                    break
+                if course_id == keep or not system.resident or self.systems.get(course_id) is not system:
+                    continue
+                total -= sizes[course_id]
+                self._checked_generations.pop(course_id, None)
+                # 第一個 RAGSystem 持有共用元件，保留在登記表中；其他課程下次使用時重新建立
+                if system is not self.root:
+                    del self.systems[course_id]
+                self.evictions += 1
+                evicted.append(system)
+            # keep 可能已被並行的另一次檢查移出
+            kept = self.systems.get(keep)
+            if kept is not None:
+                self._checked_generations[keep] = kept.current_session
+        for system in evicted:
+            system.unload()
+    
+    def known_course_ids(self) -> List[str]:
+        """已載入過或在磁碟上有索引的課程"""
+        course_ids = list(self.systems)
+        if os.path.isdir(COURSES_DIR):
+            course_ids += [name for name in sorted(os.listdir(COURSES_DIR))
+                           if name not in self.systems and COURSE_ID_PATTERN.match(name)]
+        return course_ids
+    
+    def stats(self) -> Dict[str, Any]:
+        corpora = []
+        for course_id in self.known_course_ids():
+            system = self.systems.get(course_id)
+            resident = system is not None and system.resident
+            corpora.append({
+                "course_id": course_id,
+                "resident": resident,
+                "resident_bytes": system.resident_bytes() if resident else 0,
+                "chunks": len(system.course_data) if resident else None,
+                "files": len(system.file_info) if resident else None,
+                "generation": os.path.basename(system.current_session) if resident and system.current_session else None
+            })
+        return {
+            "memory_budget_bytes": int(self.memory_budget),
+            "resident_bytes": sum(corpus["resident_bytes"] for corpus in corpora),
+            "evictions": self.evictions,
+            "corpora": corpora
+        }
 
 # 初始化 RAG 系統
 rag_system = RAGSystem()
+corpus_registry = CorpusRegistry(rag_system, memory_budget_mb=float(os.getenv('CORPUS_MEMORY_BUDGET_MB', '1024')))
 
 # 建立 FastAPI 應用
 app = FastAPI(title="RAG ON CLASS API", description="課程問答系統 API")
@@ -849,8 +4088,33 @@ app.add_middleware(
 # 掛載靜態文件
 app.mount("/frontend", StaticFiles(directory="frontend"), name="frontend")
 
-# 在程式結束時自動清空 uploads
-atexit.register(rag_system.clear_all_data)
+# 模組匯入完成、可以開始接受連線的時間（模型仍在背景載入）
+APP_READY_AT = time.perf_counter()
+print(f"模組載入完成，耗時 {APP_READY_AT - IMPORT_STARTED_AT:.2f} 秒，嵌入模型在背景載入中")
+
+@app.on_event("shutdown")
+async def shutdown():
+    await rag_system.aclose()
+
+async def get_course_system(course_id: str, create: bool = False) -> RAGSystem:
+    """取得課程的 RAGSystem；索引不在記憶體中時在執行緒池中載入，避免阻塞事件迴圈
+    
+    只有寫入索引的請求傳入 create=True，其他請求指定沒有索引的課程時不會建立目錄與登記
+    """
+    try:
+        CorpusRegistry.validate_course_id(course_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    system = corpus_registry.get_resident(course_id)
+    if system is None:
+        system = await rag_system.run_blocking(corpus_registry.get, course_id, create)
+    # 其他工作行程發布了新的索引世代時換入
+    if system.index_is_stale():
+        await rag_system.run_blocking(system.refresh_index)
+    # 本行程或其他工作行程寫入新的索引世代後，依記憶體預算移出其他課程
+    if corpus_registry.needs_budget_check(course_id):
+        await rag_system.run_blocking(corpus_registry.check_budget, course_id)
+    return system
 
 @app.get("/", response_class=HTMLResponse)
 async def root():
@@ -858,46 +4122,80 @@ async def root():
     return RedirectResponse(url="/frontend/index.html")
 
 @app.post("/api/upload")
-async def upload_files(files: List[UploadFile] = File(...)):
+async def upload_files(files: List[UploadFile] = File(...), mode: str = Form("replace"),
+                       course_id: str = Form(DEFAULT_COURSE_ID)):
     if not files:
         raise HTTPException(status_code=400, detail="請選擇要上傳的文件")
+    if mode not in ("replace", "append", "update"):
+        raise HTTPException(status_code=400, detail=f"不支援的處理模式: {mode}")
+    system = await get_course_system(course_id, create=True)
     
-    course_texts = []
-    file_types = []
+    job = system.create_ingestion_job([file.filename for file in files], mode)
+    job_dir = os.path.join(rag_system.spool_dir, job.job_id)
+    os.makedirs(job_dir, exist_ok=True)
     
-    for file in files:
-        try:
-            content = await file.read()
-            file_extension = os.path.splitext(file.filename)[1].lower()
-            file_types.append(file_extension[1:] if file_extension else "txt")
-            
-            if file_extension.lower() == '.pdf':
-                # 處理PDF文件
-                print(f"處理PDF文件: {file.filename}")
-                extracted_text = rag_system.extract_text_from_pdf(content)
-                if not extracted_text:
-                    raise HTTPException(status_code=500, detail=f"無法從PDF文件中提取文字: {file.filename}")
-                course_texts.append(extracted_text)
-            else:
-                # 處理文本文件
-                if isinstance(content, bytes):
-                    content = content.decode('utf-8')
-                course_texts.append(content)
-                
-        except UnicodeDecodeError:
-            raise HTTPException(status_code=400, detail=f"無法解碼文件內容，請確保上傳的是文本文件或PDF: {file.filename}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"讀取文件時發生錯誤：{str(e)}")
+    # 將上傳的檔案分段串流寫入磁碟，不把整個檔案讀進記憶體
+    block_size = int(os.getenv('UPLOAD_BLOCK_SIZE', str(1024 * 1024)))
+    paths = []
+    try:
+        for i, file in enumerate(files):
+            path = os.path.join(job_dir, f"{i:04d}{os.path.splitext(file.filename)[1].lower()}")
+            with open(path, 'wb') as out:
+                while True:
+                    block = await file.read(block_size)
+                    if not block:
+                        break
+                    out.write(block)
+            paths.append(path)
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        job.set_status("failed", error=str(e))
+        raise HTTPException(status_code=500, detail=f"讀取文件時發生錯誤：{str(e)}")
     
-    # 準備課程資料
-    result = rag_system.prepare_course_data(course_texts, file_types)
+    system.start_ingestion_job(job, job_dir, paths)
+    return {"job_id": job.job_id, "course_id": course_id, "status": job.status, "status_url": f"/api/jobs/{job.job_id}"}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    state = rag_system.get_job_state(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="找不到指定的上傳工作")
+    return state
+
+@app.delete("/api/documents/{file_name}")
+async def remove_document(file_name: str, course_id: str = DEFAULT_COURSE_ID):
+    system = await get_course_system(course_id)
+    if not any(info["file_name"] == file_name for info in system.file_info):
+        raise HTTPException(status_code=404, detail=f"找不到指定的文件: {file_name}")
+    result = await system.run_blocking(system.remove_documents, [file_name])
     return {"message": result}
 
 @app.post("/api/query")
 async def query(request: QueryRequest) -> ConversationResponse:
-    result = rag_system.answer_query(request.question, request.session_id)
+    system = await get_course_system(request.course_id)
+    result = await system.answer_query(request.question, request.session_id)
     return result
 
+@app.post("/api/query/stream")
+async def query_stream(request: QueryRequest):
+    system = await get_course_system(request.course_id)
+    return StreamingResponse(
+        system.stream_answer_query(request.question, request.session_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/query/batch")
+async def query_batch(request: BatchQueryRequest) -> BatchQueryResponse:
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="請提供至少一個問題")
+    max_questions = int(os.getenv('BATCH_QUERY_MAX_QUESTIONS', '50'))
+    if len(request.questions) > max_questions:
+        raise HTTPException(status_code=400, detail=f"一次最多只能提交 {max_questions} 個問題")
+    system = await get_course_system(request.course_id)
+    results = await system.answer_queries(request.questions)
+    return BatchQueryResponse(results=results)
+
 @app.post("/generate_questions")
 async def generate_questions(request: Request):
     try:
@@ -920,8 +4218,13 @@ async def generate_questions(request: Request):
                 content={"error": "問題數量必須是數字"}
             )
         
+        try:
+            system = await get_course_system(data.get("course_id", DEFAULT_COURSE_ID))
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+        
         # 檢查課程數據是否存在
-        if not rag_system.course_data:
+        if not system.course_data:
             return JSONResponse(
                 status_code=400,
                 content={"error": "請先上傳課程文件"}
@@ -931,7 +4234,7 @@ async def generate_questions(request: Request):
             # 使用已有的課程內容
             max_context_length = 2000  # 限制內容長度
             content = ""
-            for chunk in rag_system.course_data:
+            for chunk in system.course_data:
                 if len(content) + len(chunk) + 1 <= max_context_length:
                     content += chunk + "\n"
                 else:
@@ -1012,7 +4315,8 @@ async def generate_questions(request: Request):
         
         try:
             print(f"調用 API 生成 {num_questions} 個繁體中文問題...")
-            response_data = rag_system.call_groq_api(messages)
+            api_stats = {}
+            response_data = await rag_system.call_groq_api(messages, stats=api_stats)
             
             if not response_data or 'choices' not in response_data or not response_data['choices']:
                 return JSONResponse(
@@ -1056,7 +4360,8 @@ async def generate_questions(request: Request):
             return JSONResponse(content={
                 "questions": questions, 
                 "answers": answers,
-                "explanations": explanations
+                "explanations": explanations,
+                "limiter_wait_ms": api_stats.get('limiter_wait', 0.0) * 1000
             })
             
         except Exception as api_error:
@@ -1076,38 +4381,50 @@ async def generate_questions(request: Request):
         )
 
 @app.get("/api/clear-data")
-async def clear_data():
-    result = rag_system.clear_all_data()
+async def clear_data(course_id: str = DEFAULT_COURSE_ID):
+    system = await get_course_system(course_id)
+    result = await system.run_blocking(system.clear_all_data)
     return {"message": result}
 
+@app.get("/api/ready")
+async def readiness():
+    """嵌入模型載入並完成暖機後返回 200，之前返回 503，供負載平衡器與自動擴展判斷"""
+    state = rag_system.model_loader.stats()
+    return JSONResponse(status_code=200 if rag_system.model_loader.ready else 503, content=state)
+
+@app.get("/api/metrics")
+async def get_metrics():
+    metrics = rag_system.get_metrics()
+    metrics["corpora"] = corpus_registry.stats()
+    return metrics
+
+@app.get("/api/corpora")
+async def list_corpora():
+    """列出所有課程與其索引是否常駐記憶體"""
+    return corpus_registry.stats()
+
 @app.get("/api/conversations/{session_id}")
 async def get_conversation(session_id: str):
-    if session_id in rag_system.conversations:
-        return rag_system.conversations[session_id].to_dict()
+    conversation = rag_system.conversations.get(session_id)
+    if conversation is not None:
+        return conversation.to_dict()
     raise HTTPException(status_code=404, detail=f"找不到指定的對話 ID: {session_id}")
 
 @app.get("/api/file-content")
-async def get_file_content():
+async def get_file_content(course_id: str = DEFAULT_COURSE_ID):
     """獲取當前處理的文件內容"""
-    if not rag_system.current_session:
+    system = await get_course_system(course_id)
+    if not system.current_session:
         return JSONResponse(
             status_code=400,
             content={"error": "尚未處理任何文件"}
         )
     
     try:
-        # 讀取課程數據文件
-        data_path = os.path.join(rag_system.current_session, 'course_data.json')
-        if not os.path.exists(data_path):
-            return JSONResponse(
-                status_code=404,
-                content={"error": "找不到課程數據文件"}
-            )
-        
-        with open(data_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        return JSONResponse(content=data)
+        return JSONResponse(content={
+            "course_data": list(system.course_data),
+            "file_info": system.file_info
+        })
     except Exception as e:
         print(f"獲取文件內容時發生錯誤: {str(e)}")
         traceback.print_exc()
@@ -150,29 +150,13 @@ document.addEventListener('DOMContentLoaded', () => {
         }
         
         const formData = new FormData();
-        const hasPdf = Array.from(fileInput.files).some(file => file.name.toLowerCase().endsWith('.pdf'));
         
         Array.from(fileInput.files).forEach(file => {
             formData.append('files', file);
         });
         
         try {
-            // 如果有PDF文件，更新覆蓋層消息
-            if (hasPdf) {
-                showOverlay('正在處理PDF文件，這可能需要一些時間...');
-                
-                // 創建處理狀態更新計時器
-                let processingTime = 0;
-                const processingInterval = setInterval(() => {
-                    processingTime += 2;
-                    if (processingTime <= 60) {
-                        showOverlay(`正在處理PDF文件 (${processingTime}秒)...\n正在提取文字內容和圖片信息`);
-                    } else {
-                        showOverlay(`PDF處理時間較長 (${processingTime}秒)...\n可能正在進行OCR處理，請耐心等待`);
-                    }
-                }, 2000);
-            }
-            
+            // 上傳後伺服器立即返回工作編號，文件在背景處理
             const response = await fetch(`${API_BASE_URL}/api/upload`, {
                 method: 'POST',
                 body: formData
@@ -180,20 +164,24 @@ document.addEventListener('DOMContentLoaded', () => {
             
             const data = await response.json();
             
-            // 清除可能存在的處理狀態計時器
-            if (hasPdf && typeof processingInterval !== 'undefined') {
-                clearInterval(processingInterval);
+            if (!response.ok) {
+                hideOverlay();
+                showStatus(uploadStatus, data.detail || '上傳失敗', 'error');
+                return;
             }
             
-            if (response.ok) {
-                // 隱藏覆蓋層
-                hideOverlay();
-                
+            // 輪詢工作狀態並顯示實際的處理進度
+            const job = await pollIngestionJob(data.job_id);
+            
+            // 隱藏覆蓋層
+            hideOverlay();
+            
+            if (job.status === 'completed') {
                 // 成功時不顯示狀態消息
-                // showStatus(uploadStatus, data.message, 'success');
+                // showStatus(uploadStatus, job.message, 'success');
                 
                 // 更新處理結果預覽
-                updateProcessingResult(data);
+                updateProcessingResult(job);
                 
                 // 顯示已上傳文件列表 - 移除此功能防止顯示額外內容
                 // updateUploadedFilesList(fileInput.files);
@@ -205,10 +193,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 // 確保文件選擇按鈕可見
                 document.querySelector('.file-label').style.display = 'inline-block';
             } else {
-                // 隱藏覆蓋層
-                hideOverlay();
-                
-                showStatus(uploadStatus, data.detail || '上傳失敗', 'error');
+                showStatus(uploadStatus, job.error || '處理文件時發生錯誤', 'error');
             }
         } catch (error) {
             // 隱藏覆蓋層
@@ -226,6 +211,43 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
     
+    // 輪詢上傳工作直到完成或失敗，期間在覆蓋層顯示各階段進度
+    async function pollIngestionJob(jobId) {
+        while (true) {
+            const response = await fetch(`${API_BASE_URL}/api/jobs/${jobId}`);
+            const job = await response.json();
+            if (!response.ok) {
+                return { status: 'failed', error: job.detail || '無法取得處理進度' };
+            }
+            if (job.status === 'completed' || job.status === 'failed') {
+                return job;
+            }
+            showOverlay(formatJobProgress(job));
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+    
+    function formatJobProgress(job) {
+        const p = job.progress;
+        if (job.status === 'extracting') {
+            let text = `正在提取文字內容 (${p.files_extracted}/${p.files_total} 個文件)`;
+            if (p.pages_total > 0) {
+                text += `\n已解析 ${p.pages_extracted}/${p.pages_total} 頁`;
+            }
+            if (p.ocr_pages_total > 0) {
+                text += `\nOCR 處理 ${p.ocr_pages_done}/${p.ocr_pages_total} 頁`;
+            }
+            if (p.chunks_total > 0) {
+                text += `\n已編碼 ${p.chunks_embedded}/${p.chunks_total} 個段落`;
+            }
+            return text;
+        }
+        if (job.status === 'indexing') {
+            return `正在建立索引 (${p.chunks_total} 個段落)`;
+        }
+        return '正在處理上傳的文件，請稍候...';
+    }
+    
     // 更新處理結果預覽
     function updateProcessingResult(data) {
         const processingResult = document.getElementById('processing-result');
@@ -395,7 +417,7 @@ document.addEventListener('DOMContentLoaded', () => {
         sourceOutput.innerHTML = '';
         
         try {
-            const response = await fetch(`${API_BASE_URL}/api/query`, {
+            const response = await fetch(`${API_BASE_URL}/api/query/stream`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -406,30 +428,80 @@ document.addEventListener('DOMContentLoaded', () => {
                 })
             });
             
-            const data = await response.json();
+            if (!response.ok || !response.body) {
+                throw new Error(`伺服器回應錯誤: ${response.status}`);
+            }
+            
+            // 逐段讀取 Server-Sent Events，收到文字片段就立即顯示
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder('utf-8');
+            let buffer = '';
+            let answerText = '';
+            let finalData = null;
+            
+            const renderAnswer = (text) => {
+                if (typeof marked !== 'undefined') {
+                    // 如果有 marked 庫，使用它來解析 Markdown
+                    answerOutput.innerHTML = marked.parse(text || '無法獲取回答');
+                } else {
+                    // 否則使用 innerHTML 直接設置內容，允許基本的 HTML 格式
+                    answerOutput.innerHTML = text || '無法獲取回答';
+                }
+            };
             
-            // 保存或更新會話ID
-            if (data.session_id) {
-                currentSessionId = data.session_id;
-                localStorage.setItem('session_id', currentSessionId);
+            const handleEvent = (rawEvent) => {
+                let eventName = 'message';
+                const dataLines = [];
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        eventName = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataLines.push(line.slice(5).trim());
+                    }
+                });
+                if (!dataLines.length) return;
+                const data = JSON.parse(dataLines.join('\n'));
+                
+                if (data.session_id) {
+                    // 保存或更新會話ID
+                    currentSessionId = data.session_id;
+                    localStorage.setItem('session_id', currentSessionId);
+                }
+                
+                if (eventName === 'sources') {
+                    sourceOutput.textContent = data.sources || '';
+                } else if (eventName === 'token') {
+                    answerText += data.text;
+                    renderAnswer(answerText);
+                } else if (eventName === 'done') {
+                    finalData = data;
+                }
+            };
+            
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                
+                let separatorIndex;
+                while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, separatorIndex);
+                    buffer = buffer.slice(separatorIndex + 2);
+                    handleEvent(rawEvent);
+                }
             }
             
-            // 更新對話歷史
-            conversationHistory = data.history || conversationHistory;
+            const finalAnswer = finalData ? finalData.answer : answerText;
             
-            // 更新UI - 使用 innerHTML 來支援 Markdown 格式
-            if (typeof marked !== 'undefined') {
-                // 如果有 marked 庫，使用它來解析 Markdown
-                answerOutput.innerHTML = marked.parse(data.answer || '無法獲取回答');
-            } else {
-                // 否則使用 innerHTML 直接設置內容，允許基本的 HTML 格式
-                answerOutput.innerHTML = data.answer || '無法獲取回答';
+            // 更新對話歷史
+            if (finalData) {
+                conversationHistory = finalData.history || conversationHistory;
             }
             
-            sourceOutput.textContent = data.sources || '';
+            renderAnswer(finalAnswer);
             
             // 添加回答到對話歷史UI
-            addMessageToUI('assistant', data.answer);
+            addMessageToUI('assistant', finalAnswer);
             
             // 清空輸入框
             questionInput.value = '';